@@ -1,6 +1,7 @@
 import equipment
 import logging
 import os
+import threading
 import time
 
 import numpy
@@ -30,6 +31,10 @@ class DataCapture:
     def save(self, capture_id, run_exp):
         raise NotImplementedError()
 
+    def stop(self):
+        """Stop any acquisition left running on the instruments, called once the experiment ends"""
+        pass
+
     def add_post_processor(self, post_processor):
         self._post_processing.append(post_processor)
 
@@ -54,6 +59,24 @@ class DataCapture:
 
         return experiment_state
 
+    @staticmethod
+    def _capture_with_state(capture, read_state, *args):
+        """Read the experiment state while captures run on instrument workers, returns (capture result, state)
+
+        Capture is a util.Future or a list of them, instruments are idle again when this returns or raises."""
+        futures = capture if isinstance(capture, list) else [capture]
+
+        try:
+            state = read_state(*args)
+        finally:
+            # Instruments must be idle before they can be reset
+            for future in futures:
+                future.exception()
+
+        result = util.wait_all(futures)
+
+        return (result if isinstance(capture, list) else result[0]), state
+
     def _save_mat(self, prefix, capture_id, data):
         for post in self._post_processing:
             data = post.process(data)
@@ -104,8 +127,61 @@ class PulseData(DataCapture):
 
         self._scope_avg = self._cfg.getint(self._CFG_SECTION, 'scope_avg')
 
+        # Missed triggers fail the capture rather than waiting forever
+        if self._cfg.has_option(self._CFG_SECTION, 'scope_timeout'):
+            self._scope_timeout = self._cfg.getfloat(self._CFG_SECTION, 'scope_timeout')
+        else:
+            self._scope_timeout = equipment.Oscilloscope._TIMEOUT_DEFAULT
+
+        if self._cfg.has_option(self._CFG_SECTION, 'scope_settings_cache'):
+            self._scope_settings_cache = self._cfg.getboolean(self._CFG_SECTION, 'scope_settings_cache')
+        else:
+            self._scope_settings_cache = False
+
+        # Record length from a point count or a time resolution, full length if neither is given
+        if self._cfg.has_option(self._CFG_SECTION, 'scope_resolution'):
+            self._scope_points = equipment.Oscilloscope.get_waveform_points(
+                self._scope_time_div, self._cfg.getfloat(self._CFG_SECTION, 'scope_resolution'))
+        elif self._cfg.has_option(self._CFG_SECTION, 'scope_points'):
+            self._scope_points = self._cfg.getint(self._CFG_SECTION, 'scope_points')
+        else:
+            self._scope_points = None
+
+        if self._cfg.has_option(self._CFG_SECTION, 'scope_points_mode'):
+            self._scope_points_mode = self._cfg.get(self._CFG_SECTION, 'scope_points_mode').upper()
+        else:
+            self._scope_points_mode = None
+
+        # BYTE data unless the analysis needs more SNR than 8 bits can give
+        if self._cfg.has_option(self._CFG_SECTION, 'scope_snr'):
+            self._scope_format = equipment.Oscilloscope.get_waveform_format(
+                self._cfg.getfloat(self._CFG_SECTION, 'scope_snr'))
+        else:
+            self._scope_format = equipment.Oscilloscope.WAVEFORM_FORMAT.BYTE
+
+        if self._cfg.has_option(self._CFG_SECTION, 'scope_hres'):
+            self._scope_hres = self._cfg.getboolean(self._CFG_SECTION, 'scope_hres')
+        else:
+            self._scope_hres = False
+
+        # Recover from capture failures by restoring a snapshot of the setup instead of a full init
+        if self._cfg.has_option(self._CFG_SECTION, 'scope_snapshot'):
+            self._scope_snapshot_enabled = self._cfg.getboolean(self._CFG_SECTION, 'scope_snapshot')
+        else:
+            self._scope_snapshot_enabled = True
+
+        self._scope_snapshot = None
+        self._scope_pipeline_capture = None
+
+        # Acquire the next capture while the previous one is transferred from waveform memory
+        if self._cfg.has_option(self._CFG_SECTION, 'scope_pipeline'):
+            self._scope_pipeline = self._cfg.getboolean(self._CFG_SECTION, 'scope_pipeline')
+        else:
+            self._scope_pipeline = False
+
         # Connect to oscilloscope and prepare it for captures
         self._scope_address = self._cfg.get(self._CFG_SECTION, 'scope_address').split(',')
+        self._scope = None
         self._scope_init()
 
         # Lock the front panel
@@ -114,67 +190,24 @@ class PulseData(DataCapture):
     
     def _scope_init(self):
         flag = False
+
+        # Snapshot is taken again from the newly configured scope
+        self._scope_snapshot = None
     
         for scope_address in self._scope_address:
             try:
                 self._logger.warn("Initializing scope {}".format(scope_address))
-                
-                scope_connector = equipment.VISAConnector(scope_address)
+
+                # Drop the previous connection so a failed scope is opened and cleared again
+                if self._scope is not None:
+                    scope = self._scope
+                    self._scope = None
+                    equipment.registry.release(scope.get_connector())
+
+                scope_connector = equipment.registry.open(scope_address)
                 self._scope = equipment.Oscilloscope(scope_connector)
-            
-                # Clear display
-                self._scope.reset()
-                self._scope.set_channel_enable(self._scope.ALL_CHANNELS, False)
-
-                # Time scale
-                self._scope.set_time_scale(self._scope_time_div)
-                
-                if self._scope_align:
-                    self._scope.set_time_reference(self._scope.TIME_REFERENCE.LEFT)
-
-                # Triggering
-                self._scope.set_trigger_sweep(self._scope.TRIGGER_SWEEP.NORMAL)
-                self._scope.set_trigger_mode(self._scope.TRIGGER_MODE.EDGE)
-                
-                if self._scope_trig_ext:
-                    self._scope.set_trigger_edge_source(self._scope.TRIGGER_SOURCE.EXTERNAL)
-                else:
-                    self._scope.set_trigger_edge_source(self._scope.TRIGGER_SOURCE.CHANNEL, self._scope_ch_in)
-                self._scope.set_trigger_edge_level(self._scope_trig_level,
-                                                   polarity=self._scope.TRIGGER_POLARITY.POSITIVE if
-                                                   self._scope_trig_pol else self._scope.TRIGGER_POLARITY.NEGATIVE)
-
-                # Channels
-                for ch in [self._scope_ch_in, self._scope_ch_out]:
-                    self._scope.set_channel_enable(ch, True)
-                    self._scope.set_channel_atten(ch, 1)
-                    self._scope.set_channel_coupling(ch, self._scope.CHANNEL_COUPLING.DC)
-
-                self._scope.set_channel_impedance(self._scope_ch_in, self._scope.CHANNEL_IMPEDANCE.FIFTY if
-                                                  self._scope_ch_in_50r else self._scope.CHANNEL_IMPEDANCE.HIGH)
-                self._scope.set_channel_impedance(self._scope_ch_out, self._scope.CHANNEL_IMPEDANCE.FIFTY if
-                                                  self._scope_ch_out_50r else self._scope.CHANNEL_IMPEDANCE.HIGH)
-                
-                self._scope.set_channel_scale(self._scope_ch_in, self._scope_ch_in_scale)
-                self._scope.set_channel_scale(self._scope_ch_out, self._scope_ch_out_scale)
-                self._scope.set_channel_offset(self._scope_ch_in, self._scope_ch_in_offset)
-                self._scope.set_channel_offset(self._scope_ch_out, self._scope_ch_out_offset)
-
-                # Channel labels
-                self._scope.set_channel_label_visible(True)
-                self._scope.set_channel_label(self._scope_ch_in, 'IN')
-                self._scope.set_channel_label(self._scope_ch_out, 'OUT')
-
-                # Setup fast waveform dumping
-                # self._scope.setup_waveform_smart()
-                
-                # Averaging
-                if self._scope_acq_avg > 0:
-                    self._scope.set_aq_mode(self._scope.ACQUISITION_MODE.AVERAGE, self._scope_acq_avg)
-                    
-                # self._scope._connector.write(":ACQ:SRAT:ANAL 500E+6")
-                self._scope.setup_waveform(self._scope.WAVEFORM_FORMAT.BYTE)
-                
+                self._scope_setup(self._scope)
+
                 flag = True
                 break
             except:
@@ -183,112 +216,435 @@ class PulseData(DataCapture):
         if not flag:
             raise Exception('Failed to initialize scope')
 
+    def _scope_setup(self, scope):
+        scope.set_settings_cache(self._scope_settings_cache)
+
+        # Send the configuration as a few compound messages
+        with scope.batch():
+            # Clear display
+            scope.reset()
+            scope.set_channel_enable(scope.ALL_CHANNELS, False)
+
+            # Time scale
+            scope.set_time_scale(self._scope_time_div)
+        
+            if self._scope_align:
+                scope.set_time_reference(scope.TIME_REFERENCE.LEFT)
+
+            # Triggering
+            scope.set_trigger_sweep(scope.TRIGGER_SWEEP.NORMAL)
+            scope.set_trigger_mode(scope.TRIGGER_MODE.EDGE)
+        
+            if self._scope_trig_ext:
+                scope.set_trigger_edge_source(scope.TRIGGER_SOURCE.EXTERNAL)
+            else:
+                scope.set_trigger_edge_source(scope.TRIGGER_SOURCE.CHANNEL, self._scope_ch_in)
+            scope.set_trigger_edge_level(self._scope_trig_level,
+                                         polarity=scope.TRIGGER_POLARITY.POSITIVE if
+                                         self._scope_trig_pol else scope.TRIGGER_POLARITY.NEGATIVE)
+
+            # Channels
+            for ch in [self._scope_ch_in, self._scope_ch_out]:
+                scope.set_channel_enable(ch, True)
+                scope.set_channel_atten(ch, 1)
+                scope.set_channel_coupling(ch, scope.CHANNEL_COUPLING.DC)
+
+            scope.set_channel_impedance(self._scope_ch_in, scope.CHANNEL_IMPEDANCE.FIFTY if
+                                        self._scope_ch_in_50r else scope.CHANNEL_IMPEDANCE.HIGH)
+            scope.set_channel_impedance(self._scope_ch_out, scope.CHANNEL_IMPEDANCE.FIFTY if
+                                        self._scope_ch_out_50r else scope.CHANNEL_IMPEDANCE.HIGH)
+        
+            scope.set_channel_scale(self._scope_ch_in, self._scope_ch_in_scale)
+            scope.set_channel_scale(self._scope_ch_out, self._scope_ch_out_scale)
+            scope.set_channel_offset(self._scope_ch_in, self._scope_ch_in_offset)
+            scope.set_channel_offset(self._scope_ch_out, self._scope_ch_out_offset)
+
+            # Channel labels
+            scope.set_channel_label_visible(True)
+            scope.set_channel_label(self._scope_ch_in, 'IN')
+            scope.set_channel_label(self._scope_ch_out, 'OUT')
+
+            # Setup fast waveform dumping
+            # scope.setup_waveform_smart()
+        
+            # Averaging
+            if self._scope_acq_avg > 0:
+                scope.set_aq_mode(scope.ACQUISITION_MODE.AVERAGE, self._scope_acq_avg)
+            elif self._scope_hres:
+                scope.set_aq_mode(scope.ACQUISITION_MODE.HIGHRES)
+            
+            # scope._connector.write(":ACQ:SRAT:ANAL 500E+6")
+            scope.setup_waveform(self._scope_format, self._scope_points, self._scope_points_mode)
+
+    def _scope_save_snapshot(self):
+        if not self._scope_snapshot_enabled or self._scope_snapshot is not None:
+            return
+
+        try:
+            self._scope_snapshot = self._scope.get_setup()
+            self._logger.debug("Saved scope setup snapshot ({} bytes)".format(len(self._scope_snapshot)))
+        except:
+            self._logger.exception('Failed to save scope setup snapshot, recovery will use a full init')
+            self._scope_snapshot_enabled = False
+
+    def _scope_recover(self):
+        recover_start = time.time()
+
+        if self._scope_snapshot is not None:
+            try:
+                with self._scope.batch():
+                    self._scope.clear()
+                    self._scope.set_run_state(self._scope.RUN_STATE.STOP)
+
+                self._scope.set_setup(self._scope_snapshot)
+
+                # Waveform transfer settings are not part of the setup
+                self._scope.setup_waveform(self._scope_format, self._scope_points, self._scope_points_mode)
+
+                self._logger.info("Scope restored from snapshot in {:.3f} sec".format(time.time() - recover_start))
+                return
+            except:
+                self._logger.exception('Failed to restore scope setup snapshot')
+
+        self._scope_init()
+        self._logger.info("Scope re-initialized in {:.3f} sec".format(time.time() - recover_start))
+
+    def _scope_capture(self):
+        # scope_capture = self._scope.get_waveform_smart([self._scope_ch_in, self._scope_ch_out])
+        # self._scope.set_channel_scale(self._scope_ch_out, self._scope_ch_out_scale)
+        scope_capture_time, scope_capture_in = self._scope.get_waveform(self._scope_ch_in)
+        _, scope_capture_out = self._scope.get_waveform(self._scope_ch_out, trigger=False)
+
+        return scope_capture_time, scope_capture_in, scope_capture_out
+
     def save(self, capture_id, run_exp):
         experiment_state = DataCapture._save_state(self, capture_id, run_exp)
 
+        experiment_state['result_scope_bytes'] = []
+
+        if self._save_raw:
+            experiment_state['result_scope_raw_key'] = []
+            experiment_state['result_scope_raw_in'] = []
+            experiment_state['result_scope_raw_out'] = []
+
+        scope_result = self._capture_loop(capture_id, run_exp, experiment_state)
+
+        if self._scope_settings_cache:
+            self._logger.debug("Scope settings cache: {} writes skipped, {} sent".format(
+                *self._scope.get_settings_cache_stats()))
+
+        # Average across data sets in each bin
+        experiment_state['result_scope_in'] = []
+        experiment_state['result_scope_out'] = []
+
+        for result_key, scope_capture_set in self._bin_results(experiment_state, run_exp, scope_result):
+            experiment_state['result_scope_in'].append(numpy.mean(numpy.array([x[0] for x in scope_capture_set]),
+                                                                  axis=0))
+            experiment_state['result_scope_out'].append(numpy.mean(numpy.array([x[1] for x in scope_capture_set]),
+                                                                   axis=0))
+
+        self._logger.debug('Processing complete')
+
+        # Save results to .mat file
+        self._save_mat('scope_mat', capture_id, experiment_state)
+        self._logger.debug('Save complete')
+
+    def _capture_loop(self, capture_id, run_exp, experiment_state):
+        """Take scope_avg captures with _capture_step(), returns captures binned by result key
+
+        Failed captures recover the scope until more than fail_threshold have failed."""
         fail_count = 0
         scope_result = {}
 
-        scope_result_raw_key = []
-        scope_result_raw = []
+        # Scope is fully configured before the first capture, so a failure in that capture can already be recovered
+        self._scope_save_snapshot()
 
-        # Take multiple captures for averaging
-        for run in range(0, self._scope_avg):
-            self._logger.info("Capture {} of {}".format(run + 1, self._scope_avg))
+        try:
+            for run in range(0, self._scope_avg):
+                self._logger.info("Capture {} of {}".format(run + 1, self._scope_avg))
 
-            try:
-                capture_state = run_exp.get_state(capture_id)
-                result_key = run_exp.get_result_key(capture_state)
-
-                # scope_capture = self._scope.get_waveform_smart([self._scope_ch_in, self._scope_ch_out])
-                # self._scope.set_channel_scale(self._scope_ch_out, self._scope_ch_out_scale)
-                scope_capture = self._scope.get_waveform(self._scope_ch_in)
-                scope_capture_time = [x[2] for x in scope_capture]
-                scope_capture_in = [x[3] for x in scope_capture]
-                scope_capture = self._scope.get_waveform(self._scope_ch_out, trigger=False)
-                scope_capture_out = [x[3] for x in scope_capture]
-                
-                #self._scope.set_channel_scale(self._scope_ch_out, self._scope_ch_out_hr_scale)
-                #scope_capture = self._scope.get_waveform(self._scope_ch_out)
-                #scope_capture_out_hr = [x[3] for x in scope_capture]
-                
-                self._logger.info("Received {} samples".format(len(scope_capture_time)))
-
-                if 'result_scope_time' not in experiment_state:
-                    experiment_state['result_scope_time'] = scope_capture_time
-
-                if self._save_raw:
-                    scope_result_raw_key.append(result_key)
-                    #scope_result_raw.append((scope_capture_in, scope_capture_out, scope_capture_out_hr))
-                    scope_result_raw.append((scope_capture_in, scope_capture_out))
-
-                if result_key in scope_result:
-                    #scope_result[result_key].append((scope_capture_in, scope_capture_out, scope_capture_out_hr))
-                    scope_result[result_key].append((scope_capture_in, scope_capture_out))
-                else:
-                    #scope_result[result_key] = [(scope_capture_in, scope_capture_out, scope_capture_out_hr)]
-                    scope_result[result_key] = [(scope_capture_in, scope_capture_out)]
-            except:
-                fail_count += 1
+                try:
+                    result_key, scope_capture = self._capture_step(run, capture_id, run_exp, experiment_state)
+                    scope_result.setdefault(result_key, []).append(scope_capture)
+                except:
+                    # Restart the pipeline after the scope is reset
+                    self._scope_pipeline_close()
 
-                if fail_count > self._fail_threshold:
-                    self._logger.error("Capture failure limit exceeded")
-                    raise
-                else:
-                    self._logger.exception("Exception during capture ({} of {} allowed)".format(fail_count,
-                                                                                                self._fail_threshold))
-                    
-                    # Reset scope
-                    self._scope_init()
+                    fail_count += 1
+
+                    if fail_count > self._fail_threshold:
+                        self._logger.error("Capture failure limit exceeded")
+                        raise
+                    else:
+                        self._logger.exception("Exception during capture ({} of {} allowed)".format(
+                            fail_count, self._fail_threshold))
+
+                        # Reset scope
+                        self._scope_recover()
+        finally:
+            self._scope_pipeline_close()
 
         self._logger.info("Capture complete, {} bin{} created".format(len(scope_result),
                                                                       '' if len(scope_result) == 1 else 's'))
 
-        # Combine results based off sensor temperature
-        experiment_in_result = []
-        experiment_out_result = []
-        experiment_out_hr_result = []
+        return scope_result
+
+    def _capture_step(self, run, capture_id, run_exp, experiment_state):
+        """Take one capture, returns (result key, capture)"""
+        bytes_start = self._scope.get_bytes_transferred()
+
+        if self._scope_pipeline:
+            if self._scope_pipeline_capture is None:
+                self._scope_pipeline_capture = self._scope.get_waveform_pipelined(
+                    [self._scope_ch_in, self._scope_ch_out], self._scope_avg - run, self._scope_timeout)
+
+            # Next capture is already acquiring
+            scope_capture_time, (scope_capture_in, scope_capture_out) = next(self._scope_pipeline_capture)
+
+            capture_state = run_exp.get_state(capture_id)
+            result_key = run_exp.get_result_key(capture_state)
+        else:
+            # Capture runs on the scope worker while the experiment state is read
+            (scope_capture_time, scope_capture_in, scope_capture_out), capture_state = self._capture_with_state(
+                self._scope.run_async(self._scope_capture), run_exp.get_state, capture_id)
+            result_key = run_exp.get_result_key(capture_state)
+
+        experiment_state['result_scope_bytes'].append(self._scope.get_bytes_transferred() - bytes_start)
+
+        self._logger.info("Received {} samples ({} bytes)".format(len(scope_capture_time),
+                                                                 experiment_state['result_scope_bytes'][-1]))
+
+        if 'result_scope_time' not in experiment_state:
+            experiment_state['result_scope_time'] = scope_capture_time
+
+        if self._save_raw:
+            experiment_state['result_scope_raw_key'].append(result_key)
+            experiment_state['result_scope_raw_in'].append(scope_capture_in)
+            experiment_state['result_scope_raw_out'].append(scope_capture_out)
+
+        return result_key, (scope_capture_in, scope_capture_out)
+
+    def _scope_pipeline_close(self):
+        if self._scope_pipeline_capture is not None:
+            self._scope_pipeline_capture.close()
+            self._scope_pipeline_capture = None
 
+    @staticmethod
+    def _bin_results(experiment_state, run_exp, scope_result):
+        """Add the key and size of each bin to experiment_state, returns (result key, captures) in the same order"""
         result_key_name = run_exp.get_result_key_name()
 
-        # Allocate fields in result dictionary
         experiment_state['result_avg_length'] = []
 
         for name in result_key_name:
             experiment_state[name] = []
 
-        # Average across data sets in each bin
-        for result_key, scope_capture_set in scope_result.iteritems():
-            scope_capture_in_array = numpy.array([x[0] for x in scope_capture_set])
-            experiment_in_result.append(numpy.mean(scope_capture_in_array, axis=0).tolist())
-
-            scope_capture_out_array = numpy.array([x[1] for x in scope_capture_set])
-            experiment_out_result.append(numpy.mean(scope_capture_out_array, axis=0).tolist())
-            
-            #scope_capture_out_hr_array = numpy.array([x[2] for x in scope_capture_set])
-            #experiment_out_hr_result.append(numpy.mean(scope_capture_out_hr_array, axis=0).tolist())
+        scope_bins = scope_result.items()
 
-            experiment_state['result_avg_length'].append(numpy.size(scope_capture_in_array, axis=0))
+        for result_key, scope_capture_set in scope_bins:
+            experiment_state['result_avg_length'].append(len(scope_capture_set))
 
             for name_idx, param in enumerate(result_key):
                 experiment_state[result_key_name[name_idx]].append(param)
 
-        if self._save_raw:
-            experiment_state['result_scope_raw_key'] = scope_result_raw_key
-            experiment_state['result_scope_raw_in'] = [x[0] for x in scope_result_raw]
-            experiment_state['result_scope_raw_out'] = [x[1] for x in scope_result_raw]
+        return scope_bins
 
-        experiment_state['result_scope_in'] = experiment_in_result
-        experiment_state['result_scope_out'] = experiment_out_result
-        #experiment_state['result_scope_out_hr'] = experiment_out_hr_result
         
+class PulseMeasureData(PulseData):
+    """Pulse capture using the scope's built-in measurements instead of full waveforms"""
+    def __init__(self, args, cfg, result_dir):
+        # Measurements are installed by _scope_init, so parse them before the scope is set up
+        channel_map = {
+            'in': cfg.getint(self._CFG_SECTION, 'scope_ch_in'),
+            'out': cfg.getint(self._CFG_SECTION, 'scope_ch_out')
+        }
+
+        # Measurements are listed as NAME:channel[:channel], eg. VAMP:in,RIS:out,DEL:in:out
+        self._scope_measure = []
+
+        for measure in cfg.get(self._CFG_SECTION, 'scope_measure').split(','):
+            measure = measure.strip().split(':')
+            self._scope_measure.append((measure[0].upper(),) + tuple(channel_map[x.lower()] for x in measure[1:]))
+
+        # Full waveforms are only taken every n captures, never if 0
+        if cfg.has_option(self._CFG_SECTION, 'scope_measure_waveform'):
+            self._scope_measure_waveform = cfg.getint(self._CFG_SECTION, 'scope_measure_waveform')
+        else:
+            self._scope_measure_waveform = 0
+
+        PulseData.__init__(self, args, cfg, result_dir)
+
+    def _scope_init(self):
+        PulseData._scope_init(self)
+
+        self._scope.setup_measurements(self._scope_measure)
+
+    def _scope_measure_capture(self, waveform):
+        self._scope.trigger_single(self._scope_timeout)
+
+        measurement = self._scope.get_measurements(self._scope_measure)
+
+        if waveform:
+            scope_capture_time, scope_capture_in = self._scope.get_waveform(self._scope_ch_in, trigger=False)
+            _, scope_capture_out = self._scope.get_waveform(self._scope_ch_out, trigger=False)
+
+            return measurement, (scope_capture_time, scope_capture_in, scope_capture_out)
+
+        return measurement, None
+
+    def save(self, capture_id, run_exp):
+        experiment_state = DataCapture._save_state(self, capture_id, run_exp)
+
+        # Statistics cover the captures of this save only
+        self._scope.reset_measurement_statistics()
+
+        scope_result = self._capture_loop(capture_id, run_exp, experiment_state)
+
+        # Scope statistics as (current, minimum, maximum, mean, std_dev, count) for each measurement
+        scope_statistics = self._scope.get_measurement_statistics()
+
+        experiment_state['result_scope_measure_statistics'] = numpy.array([x[1:] for x in scope_statistics])
+        experiment_state['result_scope_measure_statistics_name'] = [x[0] for x in scope_statistics]
+
+        # Binned the same way as full waveform captures
+        experiment_state['result_scope_measure'] = []
+        experiment_state['result_scope_measure_name'] = [
+            "{} {}".format(measure[0], ','.join("CHAN{}".format(ch) for ch in measure[1:]))
+            for measure in self._scope_measure]
+
+        # Waveforms are only available for some bins so they carry their own keys
+        experiment_state['result_scope_waveform_key'] = []
+        experiment_state['result_scope_in'] = []
+        experiment_state['result_scope_out'] = []
+
+        for result_key, scope_capture_set in self._bin_results(experiment_state, run_exp, scope_result):
+            measurements = numpy.array([x[0] for x in scope_capture_set])
+            experiment_state['result_scope_measure'].append(numpy.nanmean(measurements, axis=0))
+
+            scope_waveform = [x[1] for x in scope_capture_set if x[1] is not None]
+
+            if len(scope_waveform) > 0:
+                experiment_state['result_scope_waveform_key'].append(result_key)
+                experiment_state['result_scope_in'].append(numpy.mean(numpy.array([x[0] for x in scope_waveform]),
+                                                                      axis=0))
+                experiment_state['result_scope_out'].append(numpy.mean(numpy.array([x[1] for x in scope_waveform]),
+                                                                       axis=0))
+
         self._logger.debug('Processing complete')
 
         # Save results to .mat file
         self._save_mat('scope_mat', capture_id, experiment_state)
         self._logger.debug('Save complete')
 
-        
+    def _capture_step(self, run, capture_id, run_exp, experiment_state):
+        waveform = self._scope_measure_waveform > 0 and run % self._scope_measure_waveform == 0
+
+        # Capture runs on the scope worker while the experiment state is read
+        (measurement, scope_capture), capture_state = self._capture_with_state(
+            self._scope.run_async(self._scope_measure_capture, waveform), run_exp.get_state, capture_id)
+        result_key = run_exp.get_result_key(capture_state)
+
+        self._logger.info("Measured {}".format(', '.join("{:.4g}".format(x) for x in measurement)))
+
+        if scope_capture is None:
+            return result_key, (measurement, None)
+
+        if 'result_scope_time' not in experiment_state:
+            experiment_state['result_scope_time'] = scope_capture[0]
+
+        return result_key, (measurement, scope_capture[1:])
+
+
+class MultiPulseData(PulseData):
+    """Pulse capture from every scope in scope_address at once, each scope on its own worker"""
+    def __init__(self, args, cfg, result_dir):
+        self._scopes = []
+
+        PulseData.__init__(self, args, cfg, result_dir)
+
+        # Recovery re-initializes every scope, no snapshot is needed
+        self._scope_snapshot_enabled = False
+
+        # First scope is locked by PulseData
+        if self._args.lock:
+            for scope in self._scopes[1:]:
+                scope.lock(True)
+
+    def _scope_init(self):
+        # Drop previous connections so failed scopes are opened and cleared again
+        for scope in self._scopes:
+            equipment.registry.release(scope.get_connector())
+
+        self._scopes = []
+        self._scope = None
+
+        for scope_address in self._scope_address:
+            self._logger.warn("Initializing scope {}".format(scope_address))
+            self._scopes.append(equipment.Oscilloscope(equipment.registry.open(scope_address)))
+
+        # Configure all scopes concurrently
+        util.wait_all([scope.run_async(self._scope_setup, scope) for scope in self._scopes])
+
+        self._scope = self._scopes[0]
+
+    def _scope_recover(self):
+        # Scopes are always re-initialized together
+        recover_start = time.time()
+
+        self._scope_init()
+        self._logger.info("Scopes re-initialized in {:.3f} sec".format(time.time() - recover_start))
+
+    def _scope_capture_multi(self, scope):
+        scope.trigger_single(self._scope_timeout)
+        scope_timestamp = time.time()
+
+        scope_capture_time, scope_capture_in = scope.get_waveform(self._scope_ch_in, trigger=False)
+        _, scope_capture_out = scope.get_waveform(self._scope_ch_out, trigger=False)
+
+        return scope_timestamp, scope_capture_time, scope_capture_in, scope_capture_out
+
+    def save(self, capture_id, run_exp):
+        experiment_state = DataCapture._save_state(self, capture_id, run_exp)
+
+        experiment_state['result_scope_address'] = self._scope_address
+        experiment_state['result_scope_timestamp'] = []
+
+        scope_result = self._capture_loop(capture_id, run_exp, experiment_state)
+
+        experiment_state['result_scope_timestamp'] = numpy.array(experiment_state['result_scope_timestamp'])
+
+        # Average across data sets in each bin
+        experiment_state['result_scope_in'] = []
+        experiment_state['result_scope_out'] = []
+
+        for result_key, scope_capture_set in self._bin_results(experiment_state, run_exp, scope_result):
+            experiment_state['result_scope_in'].append(numpy.mean([x[0] for x in scope_capture_set], axis=0))
+            experiment_state['result_scope_out'].append(numpy.mean([x[1] for x in scope_capture_set], axis=0))
+
+        self._logger.debug('Processing complete')
+
+        # Save results to .mat file
+        self._save_mat('scope_mat', capture_id, experiment_state)
+        self._logger.debug('Save complete')
+
+    def _capture_step(self, run, capture_id, run_exp, experiment_state):
+        # All scopes capture while the experiment state is read
+        scope_capture = [scope.run_async(self._scope_capture_multi, scope) for scope in self._scopes]
+        scope_capture, capture_state = self._capture_with_state(scope_capture, run_exp.get_state, capture_id)
+        result_key = run_exp.get_result_key(capture_state)
+
+        self._logger.info("Received {} samples from {} scopes".format(
+            sum(len(x[1]) for x in scope_capture), len(scope_capture)))
+
+        if 'result_scope_time' not in experiment_state:
+            experiment_state['result_scope_time'] = [x[1] for x in scope_capture]
+
+        experiment_state['result_scope_timestamp'].append([x[0] for x in scope_capture])
+
+        # Channels of all scopes stacked as (scopes, points)
+        return result_key, (numpy.array([x[2] for x in scope_capture]), numpy.array([x[3] for x in scope_capture]))
+
+
 class SweepData(PulseData):
     def __init__(self, args, cfg, result_dir):
         PulseData.__init__(self, args, cfg, result_dir)
@@ -300,18 +656,29 @@ class SweepData(PulseData):
         self._scope.set_trigger_holdoff(self._scope_trig_holdoff)
         self._scope.set_segment_count(self._scope_segment)
 
+        if self._cfg.has_option(self._CFG_SECTION, 'scope_segment_bulk'):
+            self._scope.set_segment_bulk(self._cfg.getboolean(self._CFG_SECTION, 'scope_segment_bulk'))
+
     def save(self, capture_id, run_exp):
         experiment_state = DataCapture._save_state(self, capture_id, run_exp)
 
         capture_state = run_exp.get_state(capture_id)
         
-        scope_capture = self._scope.get_waveform(self._scope_ch_in, segment=True)
-        scope_capture_time = [[x[2] for x in y] for y in scope_capture]
-        scope_capture_in = [[x[3] for x in y] for y in scope_capture]
-        scope_capture = self._scope.get_waveform(self._scope_ch_out, trigger=False, segment=True)
-        scope_capture_out = [[x[3] for x in y] for y in scope_capture]
-        
+        self._scope.trigger_single(self._scope_timeout)
+
+        # Each channel is read out as a (segments, points) array in as few transfers as the scope allows
+        scope_source = self._scope.WAVEFORM_SOURCE.CHANNEL
+        scope_raw_in, scope_capture_tag = self._scope.get_waveform_segments(scope_source, self._scope_ch_in)
+        scope_raw_out, _ = self._scope.get_waveform_segments(scope_source, self._scope_ch_out)
+
+        scope_capture_time, scope_capture_in = self._scope.process_waveform(scope_raw_in, scope_source,
+                                                                            self._scope_ch_in)
+        _, scope_capture_out = self._scope.process_waveform(scope_raw_out, scope_source, self._scope_ch_out)
+
+        self._logger.info("Received {} segments of {} samples".format(*scope_capture_in.shape))
+
         experiment_state['result_scope_time'] = scope_capture_time
+        experiment_state['result_scope_segment_time'] = scope_capture_tag
         experiment_state['result_scope_in'] = scope_capture_in
         experiment_state['result_scope_out'] = scope_capture_out
         
@@ -326,6 +693,7 @@ class VNAData(DataCapture):
     _CFG_SECTION = 'vna'
     _PATH_DATA = 'experiment.s2p'
     _PATH_STATE = 'experiment.sta'
+    _PATH_STATE_HASH = 'experiment_{}.sta'
 
     def __init__(self, args, cfg, result_dir):
         DataCapture.__init__(self, args, cfg, result_dir)
@@ -334,7 +702,45 @@ class VNAData(DataCapture):
         vna_address = self._cfg.get(self._CFG_SECTION, 'vna_address')
         self._vna_setup_path_list = self._cfg.get(self._CFG_SECTION, 'vna_setup').split(',')
 
-        vna_connector = equipment.VISAConnector(vna_address)
+        # Ports measured, data is read straight from the instrument unless the SnP file round trip is requested
+        if self._cfg.has_option(self._CFG_SECTION, 'vna_ports'):
+            self._vna_ports = [int(x) for x in self._cfg.get(self._CFG_SECTION, 'vna_ports').split(',')]
+        else:
+            self._vna_ports = [1, 2]
+
+        if self._cfg.has_option(self._CFG_SECTION, 'vna_binary'):
+            self._vna_binary = self._cfg.getboolean(self._CFG_SECTION, 'vna_binary')
+        else:
+            self._vna_binary = True
+
+        # Touchstone export alongside the .mat results
+        if self._cfg.has_option(self._CFG_SECTION, 'vna_save_snp'):
+            self._vna_save_snp = self._cfg.getboolean(self._CFG_SECTION, 'vna_save_snp')
+        else:
+            self._vna_save_snp = False
+
+        # Keep uploaded setup files on the VNA, named by content hash, so they are only transferred once
+        if self._cfg.has_option(self._CFG_SECTION, 'vna_state_cache'):
+            self._vna_state_cache = self._cfg.getboolean(self._CFG_SECTION, 'vna_state_cache')
+        else:
+            self._vna_state_cache = True
+
+        # Sweep all setups from a single trigger, each setup is recalled into its own channel
+        if self._cfg.has_option(self._CFG_SECTION, 'vna_multichannel'):
+            self._vna_multichannel = self._cfg.getboolean(self._CFG_SECTION, 'vna_multichannel')
+        else:
+            self._vna_multichannel = False
+
+        if self._vna_multichannel and len(self._vna_setup_path_list) > len(equipment.NetworkAnalyzer.CHANNEL_REGISTER):
+            raise ValueError("At most {} VNA setups can be merged into channels".format(
+                len(equipment.NetworkAnalyzer.CHANNEL_REGISTER)))
+
+        self._vna_state_index = {}
+        self._vna_state_active = None
+        self._vna_setup_hash = {}
+        self._vna_setup_uploaded = {}
+
+        vna_connector = equipment.registry.open(vna_address)
         self._vna = equipment.NetworkAnalyzer(vna_connector)
 
         # self._vna.reset()
@@ -344,7 +750,30 @@ class VNAData(DataCapture):
             self._vna.lock(True, True, False)
 
     def save(self, capture_id, run_exp):
-        experiment_state = DataCapture._save_state(self, capture_id, run_exp)
+        # Sweeps run on the VNA worker while the experiment state is read
+        if self._vna_multichannel:
+            vna_capture = self._vna.run_async(self._vna_capture_multichannel, capture_id)
+        else:
+            vna_capture = self._vna.run_async(self._vna_capture, capture_id)
+
+        try:
+            vna_result, experiment_state = self._capture_with_state(vna_capture, self._save_state, capture_id, run_exp)
+        except:
+            if vna_capture.exception() is not None:
+                # The instrument may have been reset, upload setup files again on the next capture
+                self._vna_state_index.clear()
+                self._vna_setup_uploaded.clear()
+                self._vna_state_active = None
+
+            raise
+
+        experiment_state.update(vna_result)
+
+        # Save to .mat file with state data
+        self._save_mat('vna_mat', capture_id, experiment_state)
+
+    def _vna_capture(self, capture_id):
+        vna_result = {}
 
         # Capture VNA data
         snp_frequency_full = []
@@ -352,47 +781,182 @@ class VNAData(DataCapture):
 
         for vna_setup_path in self._vna_setup_path_list:
             vna_setup_name = os.path.splitext(os.path.basename(vna_setup_path))[0]
-            snp_path = os.path.join(self._result_dir, self._gen_file_name("vna_snp_{}".format(vna_setup_name), 's2p',
+            snp_path = os.path.join(self._result_dir, self._gen_file_name("vna_snp_{}".format(vna_setup_name),
+                                                                          "s{}p".format(len(self._vna_ports)),
                                                                           capture_id))
 
+            self._vna_load_setup(vna_setup_path)
+
+            if self._vna_binary:
+                self._vna.setup_sparameters(self._vna_ports)
+
+            # Capture data
+            self._logger.info("Trigger capture")
+            self._vna.trigger()
+            self._vna.wait_measurement()
+
+            if self._vna_binary:
+                # Read stimulus and corrected data as binary blocks
+                snp_frequency = self._vna.get_frequency_data()
+                snp_data = self._vna.get_sparameters(self._vna_ports)
+
+                vna_result['result_snp_type'] = 'S'
+                vna_result['result_snp_r'] = self._vna.get_impedance()
+
+                if self._vna_save_snp:
+                    util.write_snp(snp_path, snp_frequency, snp_data, r=vna_result['result_snp_r'])
+                    util.snp_cache.save_sidecar(snp_path, ('S', vna_result['result_snp_r'], snp_frequency, snp_data))
+                    self._logger.info("Saved SNP file: {}".format(snp_path))
+            else:
+                # Save SNP file and transfer to PC
+                self._vna.data_save_snp(self._PATH_DATA, self._vna_ports)
+                self._vna.file_transfer(snp_path, self._PATH_DATA, False)
+                self._vna.file_delete(self._PATH_DATA)
+                self._logger.info("Transfered SNP file: {}".format(snp_path))
+
+                # Read touchstone file, the parsed copy is kept in a sidecar for later reads
+                snp = util.read_snp(snp_path)
+                util.snp_cache.save_sidecar(snp_path, snp)
+                snp_type, snp_r, snp_frequency, snp_data = snp
+
+                vna_result['result_snp_type'] = snp_type
+                vna_result['result_snp_r'] = snp_r
+
+            # Append VNA data
+            snp_frequency_full.append(snp_frequency)
+            snp_data_full.append(snp_data)
+
+        vna_result['result_snp_frequency'] = numpy.concatenate(snp_frequency_full)
+        vna_result['result_snp_data'] = numpy.concatenate(snp_data_full)
+
+        return vna_result
+
+    def _vna_capture_multichannel(self, capture_id):
+        vna_result = {}
+        channel_count = len(self._vna_setup_path_list)
+
+        self._vna_load_multichannel()
+
+        # Capture data
+        self._logger.info("Trigger capture of {} channels".format(channel_count))
+        self._vna.trigger_all(channel_count)
+        self._vna.wait_measurement()
+
+        # Read all channels back in one batch
+        snp_frequency = []
+        snp_data = []
+
+        for channel in range(1, channel_count + 1):
+            snp_frequency.append(self._vna.get_frequency_data(channel))
+            snp_data.append(self._vna.get_sparameters(self._vna_ports, channel))
+
+        vna_result['result_snp_type'] = 'S'
+        vna_result['result_snp_r'] = self._vna.get_impedance()
+
+        # Merge segments into a single sorted axis, overlapping points are taken from the first setup listed
+        snp_frequency = numpy.concatenate(snp_frequency)
+        snp_data = numpy.concatenate(snp_data)
+
+        snp_frequency, index = numpy.unique(snp_frequency, return_index=True)
+        snp_data = snp_data[index]
+
+        if self._vna_save_snp:
+            snp_path = os.path.join(self._result_dir, self._gen_file_name("vna_snp",
+                                                                          "s{}p".format(len(self._vna_ports)),
+                                                                          capture_id))
+            util.write_snp(snp_path, snp_frequency, snp_data, r=vna_result['result_snp_r'])
+            util.snp_cache.save_sidecar(snp_path, ('S', vna_result['result_snp_r'], snp_frequency, snp_data))
+            self._logger.info("Saved SNP file: {}".format(snp_path))
+
+        vna_result['result_snp_frequency'] = snp_frequency
+        vna_result['result_snp_data'] = snp_data
+
+        return vna_result
+
+    def _vna_load_multichannel(self):
+        # Merged state is identified by the hashes of all setups in channel order
+        merge_hash = '+'.join(self._vna_get_setup_hash(x) for x in self._vna_setup_path_list)
+
+        if merge_hash == self._vna_state_active:
+            return
+
+        # Store the channel settings of each setup in a register
+        for register, vna_setup_path in zip(self._vna.CHANNEL_REGISTER, self._vna_setup_path_list):
+            self._vna_load_setup(vna_setup_path)
+            self._vna.channel_store(register)
+
+        # Build one state with a channel per setup, starting from the last state loaded
+        self._vna_state_active = None
+        self._vna.set_channel_count(len(self._vna_setup_path_list))
+
+        for channel, register in enumerate(self._vna.CHANNEL_REGISTER[:len(self._vna_setup_path_list)]):
+            self._vna.channel_recall(register, channel + 1)
+            self._vna.setup_sparameters(self._vna_ports, channel + 1)
+
+        self._vna_state_active = merge_hash
+
+        self._logger.info("Merged {} VNA setup files into channels".format(len(self._vna_setup_path_list)))
+
+    def _vna_get_setup_hash(self, vna_setup_path):
+        # Only hash the file again when it has been modified
+        stat = os.stat(vna_setup_path)
+        key = (stat.st_size, stat.st_mtime)
+
+        if vna_setup_path not in self._vna_setup_hash or self._vna_setup_hash[vna_setup_path][0] != key:
+            self._vna_setup_hash[vna_setup_path] = (key, util.file_hash(vna_setup_path))
+
+        return self._vna_setup_hash[vna_setup_path][1]
+
+    def _vna_load_setup(self, vna_setup_path):
+        if not self._vna_state_cache:
             # Transfer setup file to VNA and then load it
             self._vna.file_transfer(vna_setup_path, self._PATH_STATE, True)
             self._vna.state_load(self._PATH_STATE)
             self._vna.file_delete(self._PATH_STATE)
             self._logger.info("Loaded VNA setup file: {}".format(vna_setup_path))
+            return
 
-            # Capture data
-            self._logger.info("Trigger capture")
-            self._vna.trigger()
-            self._vna.wait_measurement()
+        setup_hash = self._vna_get_setup_hash(vna_setup_path)
 
-            # Save S2P file and transfer to PC
-            self._vna.data_save_snp(self._PATH_DATA, [1, 2])
-            self._vna.file_transfer(snp_path, self._PATH_DATA, False)
-            self._vna.file_delete(self._PATH_DATA)
-            self._logger.info("Transfered SNP file: {}".format(snp_path))
+        # Delete the copy of a setup file that has since been modified, unless another setup path still uses it
+        old_hash = self._vna_setup_uploaded.get(vna_setup_path)
 
-            # Read touchstone file
-            snp_data = util.read_snp(snp_path)
+        if old_hash is not None and old_hash != setup_hash:
+            del self._vna_setup_uploaded[vna_setup_path]
 
-            experiment_state['result_snp_type'] = snp_data[0]
-            experiment_state['result_snp_r'] = snp_data[1]
-            snp_data_merge = snp_data[2]
+            if old_hash not in self._vna_setup_uploaded.values() and old_hash in self._vna_state_index:
+                old_remote_path = self._vna_state_index.pop(old_hash)
+                self._vna.file_delete(old_remote_path)
+                self._logger.info("Deleted outdated VNA setup file: {}".format(old_remote_path))
 
-            # Append VNA data
-            snp_frequency_full.extend([d[0] for d in snp_data_merge])
-            snp_data_full.extend([d[1] for d in snp_data_merge])
+        self._vna_setup_uploaded[vna_setup_path] = setup_hash
 
-        experiment_state['result_snp_frequency'] = snp_frequency_full
-        experiment_state['result_snp_data'] = snp_data_full
+        if setup_hash == self._vna_state_active:
+            self._logger.debug("VNA setup file already active: {}".format(vna_setup_path))
+            return
 
-        # Save to .mat file with state data
-        self._save_mat('vna_mat', capture_id, experiment_state)
+        remote_path = self._vna_state_index.get(setup_hash)
+
+        if remote_path is None:
+            remote_path = self._PATH_STATE_HASH.format(setup_hash[:16])
+            self._vna.file_transfer(vna_setup_path, remote_path, True)
+            self._vna_state_index[setup_hash] = remote_path
+            self._logger.info("Transferred VNA setup file: {} ({})".format(vna_setup_path, remote_path))
+
+        # Clear the active state first so a failed load is never skipped on the next capture
+        self._vna_state_active = None
+        self._vna.state_load(remote_path)
+        self._vna_state_active = setup_hash
+
+        self._logger.info("Loaded VNA setup file: {}".format(vna_setup_path))
 
 
 class FrequencyData(DataCapture):
     _CFG_SECTION = 'frequency'
 
+    # Continuous acquisition configures the counter itself
+    _COUNTER_STREAM = False
+
     def __init__(self, args, cfg, result_dir):
         DataCapture.__init__(self, args, cfg, result_dir)
 
@@ -404,30 +968,59 @@ class FrequencyData(DataCapture):
         self._counter_delay = cfg.getfloat(self._CFG_SECTION, 'counter_delay')
 
         # Connect to frequency counter
-        counter_connector = equipment.VISAConnector(counter_address)
+        counter_connector = equipment.registry.open(counter_address)
         self._counter = equipment.FrequencyCounter(counter_connector)
 
+        # Take all readings from one trigger and fetch them in a single transfer
+        if cfg.has_option(self._CFG_SECTION, 'counter_buffered'):
+            self._counter_buffered = cfg.getboolean(self._CFG_SECTION, 'counter_buffered')
+        else:
+            self._counter_buffered = True
+
+        if cfg.has_option(self._CFG_SECTION, 'counter_timestamps'):
+            counter_timestamps = cfg.getboolean(self._CFG_SECTION, 'counter_timestamps')
+        else:
+            counter_timestamps = False
+
         self._counter.reset()
         self._counter.set_impedance(counter_impedance)
         self._counter.set_measurement_time(counter_period)
 
+        if self._counter_buffered and not self._COUNTER_STREAM:
+            # Delay between readings is kept by the sample timer, on top of the gate time
+            counter_interval = counter_period + self._counter_delay if self._counter_delay > 0 else None
+            self._counter.setup_buffer(self._counter_average, counter_interval, counter_timestamps)
+
         # if counter_average > 1:
         #    self._counter.set_calculate_average(True, equipment.FrequencyCounter.AVERAGE_TYPE.MEAN, counter_average)
 
     def save(self, capture_id, run_exp):
-        experiment_state = DataCapture._save_state(self, capture_id, run_exp)
+        # Measurement runs on the counter worker while the experiment state is read
+        (result_frequency, result_timestamp), experiment_state = self._capture_with_state(
+            self._counter.run_async(self._counter_capture), self._save_state, capture_id, run_exp)
+
+        experiment_state['result_counter_frequency'] = result_frequency
+
+        if result_timestamp is not None:
+            experiment_state['result_counter_timestamp'] = result_timestamp
+
+        self._save_mat('freq', capture_id, experiment_state)
+
+    def _counter_capture(self):
+        if self._counter_buffered:
+            return self._counter.read_buffer()
 
         # Get frequency from counter
         self._counter.trigger()
         self._counter.wait_measurement()
 
-        experiment_state['result_counter_frequency'] = []
+        result_frequency = []
 
         for run in range(self._counter_average):
             time.sleep(self._counter_delay)
-            experiment_state['result_counter_frequency'].append(self._counter.get_frequency())
+            result_frequency.append(self._counter.get_frequency())
 
-        self._save_mat('freq', capture_id, experiment_state)
+        return numpy.array(result_frequency), None
 
 
 class FrequencyDataLegacy(FrequencyData):
@@ -445,13 +1038,8 @@ class FrequencyDataLegacy(FrequencyData):
         fail_count = 0
 
         while True:
-            result_frequency = []
-
             try:
-                for run in range(self._counter_average):
-                    time.sleep(self._counter_delay)
-                    result_frequency.append(self._counter.get_frequency())
-
+                result_frequency, _ = self._counter_capture()
                 break
             except:
                 self._logger.exception('Exception during capture')
@@ -467,7 +1055,7 @@ class FrequencyDataLegacy(FrequencyData):
             post.process(experiment_state)
 
         # Take mean of measured values
-        result_frequency = sum(result_frequency) / len(result_frequency)
+        result_frequency = numpy.mean(result_frequency)
         
         freq_str = "{:.2f}".format(result_frequency)
 
@@ -475,6 +1063,177 @@ class FrequencyDataLegacy(FrequencyData):
             f.write(self._DELIMITER.join([date_str, freq_str, freq_str]) + '\n')
 
 
+class FrequencyStream:
+    """Background reader appending time-stamped counter readings to a file and an in-memory ring"""
+    RECORD = numpy.dtype([('timestamp', '<f8'), ('frequency', '<f8')])
+
+    def __init__(self, counter, path, ring_length, poll_interval, gap_free=False):
+        self._counter = counter
+        self._path = path
+        self._poll_interval = poll_interval
+        self._gap_free = gap_free
+
+        self._logger = logging.getLogger(__name__)
+
+        # Readings are numbered from the start of the stream, the ring holds the most recent
+        self._ring = numpy.zeros(ring_length, dtype=self.RECORD)
+        self._count = 0
+
+        self._update = threading.Condition()
+        self._stop = threading.Event()
+
+        self._thread = threading.Thread(target=self._receive, name="Frequency stream")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=False):
+        self._stop.set()
+
+        if wait:
+            self._thread.join()
+
+    def is_running(self):
+        return not self._stop.is_set()
+
+    def get_path(self):
+        return self._path
+
+    def wait_count(self, count, timeout=None):
+        """Wait until more than count readings have been received, returns the number received"""
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self._update:
+            while self._count <= count and self.is_running():
+                if deadline is None:
+                    self._update.wait(self._poll_interval)
+                elif time.time() < deadline:
+                    self._update.wait(min(self._poll_interval, deadline - time.time()))
+                else:
+                    break
+
+            return self._count
+
+    def get_readings(self, start, stop=None):
+        """Return readings by index, readings no longer in the ring are skipped"""
+        with self._update:
+            stop = self._count if stop is None else min(stop, self._count)
+            start = max(start, stop - len(self._ring), 0)
+
+            return self._ring[numpy.arange(start, stop) % len(self._ring)]
+
+    def get_window(self, seconds):
+        """Return the readings from the last number of seconds"""
+        readings = self.get_readings(0)
+
+        if len(readings) == 0:
+            return readings
+
+        return readings[numpy.searchsorted(readings['timestamp'], readings['timestamp'][-1] - seconds):]
+
+    def _receive(self):
+        try:
+            self._counter.start_stream(self._gap_free)
+
+            try:
+                self._receive_readings()
+            finally:
+                # Abort acquisition however the stream ends
+                self._counter.stop_stream()
+        except:
+            self._stop.set()
+            self._logger.exception('Exception occurred in frequency stream thread', exc_info=True)
+
+            with self._update:
+                self._update.notify_all()
+
+            raise
+
+    def _receive_readings(self):
+        # Instrument timestamps count from the start of acquisition
+        start_time = time.time()
+
+        with open(self._path, 'ab') as f:
+            while not self._stop.is_set():
+                frequency, timestamp = self._counter.read_stream()
+
+                if len(frequency) > 0:
+                    records = numpy.empty(len(frequency), dtype=self.RECORD)
+                    records['timestamp'] = start_time + timestamp
+                    records['frequency'] = frequency
+
+                    # Chunks are appended as they arrive so the file can be read while streaming
+                    records.tofile(f)
+                    f.flush()
+
+                    with self._update:
+                        ring_records = records[-len(self._ring):]
+                        index = numpy.arange(self._count + len(records) - len(ring_records),
+                                             self._count + len(records)) % len(self._ring)
+
+                        self._ring[index] = ring_records
+                        self._count += len(records)
+
+                        self._update.notify_all()
+
+                # Readings accumulate in instrument memory in the meantime
+                self._stop.wait(self._poll_interval)
+
+
+class FrequencyStreamData(FrequencyData):
+    _COUNTER_STREAM = True
+
+    def __init__(self, args, cfg, result_dir):
+        FrequencyData.__init__(self, args, cfg, result_dir)
+
+        # Number of readings kept in memory for rolling windows
+        if cfg.has_option(self._CFG_SECTION, 'counter_stream_ring'):
+            stream_ring = cfg.getint(self._CFG_SECTION, 'counter_stream_ring')
+        else:
+            stream_ring = 1000000
+
+        # Interval between reads of instrument memory, does not limit the reading rate
+        if cfg.has_option(self._CFG_SECTION, 'counter_stream_poll'):
+            stream_poll = cfg.getfloat(self._CFG_SECTION, 'counter_stream_poll')
+        else:
+            stream_poll = 0.1
+
+        if cfg.has_option(self._CFG_SECTION, 'counter_gap_free'):
+            gap_free = cfg.getboolean(self._CFG_SECTION, 'counter_gap_free')
+        else:
+            gap_free = False
+
+        # Readings are stored as (timestamp, frequency) float64 records
+        stream_path = os.path.join(self._result_dir, self._gen_file_name('freq_stream', 'bin', '0'))
+        self._logger.info("Stream file: {}".format(stream_path))
+
+        self._stream = FrequencyStream(self._counter, stream_path, stream_ring, stream_poll, gap_free)
+        self._stream_index = 0
+
+    def get_window(self, seconds):
+        return self._stream.get_window(seconds)
+
+    def stop(self):
+        # Counter acquisition is aborted by the stream thread on its way out
+        self._stream.stop(True)
+
+    def save(self, capture_id, run_exp):
+        # Each capture holds the readings received since the previous one
+        count = self._stream.wait_count(self._stream_index)
+
+        if count <= self._stream_index:
+            raise equipment.InstrumentException('Frequency stream stopped')
+
+        readings = self._stream.get_readings(self._stream_index, count)
+        self._stream_index = count
+
+        experiment_state = DataCapture._save_state(self, capture_id, run_exp)
+        experiment_state['result_counter_frequency'] = readings['frequency']
+        experiment_state['result_counter_timestamp'] = readings['timestamp']
+        experiment_state['result_counter_stream'] = self._stream.get_path()
+
+        self._save_mat('freq', capture_id, experiment_state)
+
+
 class MKSData(DataCapture):
     _CFG_SECTION = 'mks'
 
@@ -486,7 +1245,7 @@ class MKSData(DataCapture):
         self._timeout = self._cfg.getfloat(self._CFG_SECTION, 'timeout')
 
         # Connect to MKS
-        self._mks = mks.MKSSerialMonitor(mks_port)
+        self._mks = mks.open_monitor(mks_port)
 
     def save(self, capture_id, run_exp):
         # If data is too old then wait for an update
@@ -1,21 +1,150 @@
+import contextlib
 import logging
+import math
+import sys
+import threading
 import time
-import struct
 
+import numpy
 import visa
 
 import util
 
+# One VISA resource manager is shared by every connector in the process
+_resource_manager = None
+_resource_manager_lock = threading.Lock()
+
+# Guards lazy creation of executor threads and their registration with connectors
+_executor_lock = threading.RLock()
+
+
+def get_resource_manager():
+    global _resource_manager
+
+    with _resource_manager_lock:
+        if _resource_manager is None:
+            _resource_manager = visa.ResourceManager()
+
+        return _resource_manager
+
 
 class InstrumentConnector:
     """Base class for instrument connectors"""
+    _BATCH_MAX_LENGTH = 1024
+
+    # Request priorities, control loop writes are served before state reads and bulk transfers
+    PRIORITY = util.enum(CONTROL=0, STATE=1, BULK=2)
+
     def __init__(self, address):
         self._address = address
         self._logger = logging.getLogger(__name__)
 
+        # Pending batched commands, kept per thread so a batch never picks up another thread's writes
+        self._batch = threading.local()
+
+        # Workers serving this connector, stopped when it is closed
+        self._executors = []
+
     def get_address(self):
         return self._address
 
+    def add_executor(self, executor):
+        """Shut down a util.Executor when the connector is closed"""
+        with _executor_lock:
+            self._executors.append(executor)
+
+    def close(self):
+        with _executor_lock:
+            executors = self._executors
+            self._executors = []
+
+        for executor in executors:
+            executor.shutdown(False)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Combine writes made in the block into ;-separated SCPI messages"""
+        if getattr(self._batch, 'queue', None) is not None:
+            # Nested batches join the outer one
+            yield
+            return
+
+        self._batch.queue = []
+        self._batch.length = 0
+        self._batch.bus_address = None
+
+        try:
+            yield
+        except:
+            # Drop the incomplete command sequence
+            self._batch.queue = None
+            raise
+
+        try:
+            self._batch_flush()
+        finally:
+            self._batch.queue = None
+
+    def query_compound(self, queries, bus_address=None):
+        response = self.query(';'.join(queries), bus_address).rstrip().split(';')
+
+        if len(response) != len(queries):
+            raise InstrumentException("Expected {} responses but got {}".format(len(queries), len(response)))
+
+        return response
+
+    def _batch_append(self, data, bus_address):
+        if getattr(self._batch, 'queue', None) is None:
+            return False
+
+        bus_address = self._bus_key(bus_address)
+
+        # Commands for different bus addresses cannot share a message
+        if self._batch.queue and (self._batch.bus_address != bus_address or
+                                  self._batch.length + len(data) + 1 > self._BATCH_MAX_LENGTH):
+            self._batch_flush()
+
+        self._batch.queue.append(data)
+        self._batch.length += len(data) + 1
+        self._batch.bus_address = bus_address
+
+        return True
+
+    def _batch_prefix(self, bus_address):
+        # Pending writes for the same bus address are sent ahead of a query in the same message
+        if not getattr(self._batch, 'queue', None):
+            return ''
+
+        if self._batch.bus_address != self._bus_key(bus_address):
+            self._batch_flush()
+            return ''
+
+        prefix = ';'.join(self._batch.queue) + ';'
+
+        self._batch.queue = []
+        self._batch.length = 0
+
+        return prefix
+
+    def _batch_flush(self):
+        if not getattr(self._batch, 'queue', None):
+            return
+
+        data = ';'.join(self._batch.queue)
+
+        self._batch.queue = []
+        self._batch.length = 0
+
+        self._write(data, self._batch.bus_address)
+
+    @staticmethod
+    def _bus_key(bus_address):
+        # Instruments without a bus address pass either None or False
+        return None if bus_address is False else bus_address
+
+    def _write(self, data, bus_address):
+        raise NotImplementedError()
+
     def write(self, data):
         raise NotImplementedError()
         
@@ -28,18 +157,181 @@ class InstrumentConnector:
     def query_raw(self, data):
         raise NotImplementedError()
 
+    def query_block(self, data):
+        raise NotImplementedError()
+
+    def device_clear(self):
+        """Clear the device interface, discarding any response still waiting to be read"""
+        raise NotImplementedError()
+
+    def enable_srq(self):
+        """Queue service request events, returns False if the interface does not support them"""
+        return False
+
+    def wait_srq(self, timeout):
+        """Wait for a service request, returns None if service requests are not supported"""
+        return None
+
+    # Connectors without their own I/O worker run asynchronous requests on a shared executor thread
+    def _get_executor(self):
+        with _executor_lock:
+            if getattr(self, '_executor', None) is None:
+                self._executor = util.Executor("IO {}".format(self.get_address()))
+                self.add_executor(self._executor)
+
+            return self._executor
+
+    def write_async(self, data, *args, **kwargs):
+        self._batch_flush()
+        return self._get_executor().submit(self.write, data, *args, **kwargs)
+
+    def query_async(self, data, *args, **kwargs):
+        return self._get_executor().submit(self.query, data, *args, **kwargs)
+
+    def query_raw_async(self, data, *args, **kwargs):
+        return self._get_executor().submit(self.query_raw, data, *args, **kwargs)
+
+    def query_block_async(self, data, *args, **kwargs):
+        return self._get_executor().submit(self.query_block, data, *args, **kwargs)
+
+
+class IORequest:
+    """Connector request queued on an IOScheduler"""
+    def __init__(self, priority, bus_address, func, args):
+        self.priority = priority
+        self.bus_address = bus_address
+        self.func = func
+        self.args = args
+        self.time = time.time()
+        self.future = util.Future()
+
+
+class IOScheduler:
+    """Worker thread serving connector requests in priority order
+
+    Within a priority level, requests for the selected bus address are served first."""
+    _GROUP_WINDOW = 1.0
+    _HOLD_TIME = 0.02
+
+    def __init__(self, name):
+        self._pending = []
+        self._condition = threading.Condition()
+
+        # Bus address selected by the last request served, and the one arrival order would have selected
+        self._bus_address = None
+        self._bus_address_time = 0
+        self._arrival_bus_address = None
+        self._arrival_switches = 0
+
+        self._stopped = False
+
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, priority, bus_address, func, *args):
+        request = IORequest(priority, bus_address, func, args)
+
+        # Requests made while serving a request run immediately
+        if threading.current_thread() is self._thread:
+            self._execute(request)
+            return request.future
+
+        with self._condition:
+            if bus_address is not None and bus_address != self._arrival_bus_address:
+                self._arrival_bus_address = bus_address
+                self._arrival_switches += 1
+
+            self._pending.append(request)
+            self._condition.notify()
+
+        return request.future
+
+    def call(self, priority, bus_address, func, *args):
+        return self.submit(priority, bus_address, func, *args).result()
+
+    def stop(self):
+        """Stop the worker once pending requests are served"""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+
+        if threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    def get_arrival_switches(self):
+        return self._arrival_switches
+
+    def _next_request(self):
+        priority = min(request.priority for request in self._pending)
+        candidates = [request for request in self._pending if request.priority == priority]
+        oldest = candidates[0]
+
+        # Defer requests for other addresses, but not for longer than the grouping window
+        if time.time() - oldest.time < self._GROUP_WINDOW:
+            for request in candidates:
+                if request.bus_address is None or request.bus_address == self._bus_address:
+                    self._pending.remove(request)
+                    return request
+
+            # Callers usually follow one request with another for the same device, so hold the bus briefly
+            if time.time() - self._bus_address_time < self._HOLD_TIME:
+                return None
+
+        self._pending.remove(oldest)
+        return oldest
+
+    def _execute(self, request):
+        try:
+            result = request.func(*request.args)
+        except:
+            request.future.set_exception(sys.exc_info())
+        else:
+            request.future.set_result(result)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                request = None
+
+                while request is None:
+                    while not self._pending:
+                        if self._stopped:
+                            return
+
+                        self._condition.wait()
+
+                    request = self._next_request()
+
+                    if request is None:
+                        self._condition.wait(self._HOLD_TIME)
+
+            if request.bus_address is not None:
+                self._bus_address = request.bus_address
+
+            self._execute(request)
+            self._bus_address_time = time.time()
+
 
 class VISAConnector(InstrumentConnector):
+    _BLOCK_CHUNK_SIZE = 256 * 1024
+    _BUS_SETTLE_TIME = 0.5
+
     def __init__(self, address, term_chars=None, use_bus_address=False):
         InstrumentConnector.__init__(self, address)
 
-        resource_manager = visa.ResourceManager()
-
+        self._term_chars = term_chars
+        self._srq_enabled = None
         self._use_bus_address = use_bus_address
         self._last_bus_address = False
 
+        # Bus switching statistics
+        self._bus_switches = 0
+        self._bus_settle_probe = True
+        self._bus_settle_time = None
+
         # Open resource
-        self._instrument = resource_manager.open_resource(address)
+        self._instrument = get_resource_manager().open_resource(address)
 
         # Specify termination character(s) if provided
         if term_chars is not None:
@@ -50,38 +342,167 @@ class VISAConnector(InstrumentConnector):
         
         self._instrument.timeout = 10000
 
+        # All I/O runs on one worker per resource, requests from different threads are served by priority and
+        # grouped by bus address to avoid switching back and forth
+        self._scheduler = IOScheduler("IO {}".format(address))
+
         self._logger.info("{} Connected".format(self.get_address()))
 
+    def close(self):
+        self._batch_flush()
+        InstrumentConnector.close(self)
+        self._scheduler.stop()
+        self._instrument.close()
+
+        self._logger.info("{} Disconnected".format(self.get_address()))
+
+    def get_term_chars(self):
+        return self._term_chars
+
+    def enable_srq(self):
+        if self._srq_enabled is None:
+            self._srq_enabled = self._submit(self.PRIORITY.CONTROL, None, self._enable_srq).result()
+
+        return self._srq_enabled
+
+    def _enable_srq(self):
+        # Events are queued from now on, so a request raised before the wait starts is not missed
+        try:
+            self._instrument.enable_event(visa.constants.VI_EVENT_SERVICE_REQ, visa.constants.VI_QUEUE)
+        except:
+            self._logger.info("{} Service requests not supported, polling for completion".format(
+                self.get_address()))
+            return False
+
+        return True
+
+    def wait_srq(self, timeout):
+        if not self._srq_enabled:
+            return None
+
+        # Waiting on an event doesn't need the worker, other requests are served in the meantime
+        try:
+            self._instrument.wait_on_event(visa.constants.VI_EVENT_SERVICE_REQ, max(1, int(timeout * 1000)))
+        except visa.VisaIOError as e:
+            if e.error_code == visa.constants.VI_ERROR_TMO:
+                return False
+
+            raise
+
+        return True
+
+    def is_bus_addressed(self):
+        return self._use_bus_address
+
+    def get_bus_stats(self):
+        return {
+            'switches': self._bus_switches,
+            'switches_avoided': max(0, self._scheduler.get_arrival_switches() - self._bus_switches),
+            'settle_time': self._bus_settle_time
+        }
+
+    def _submit(self, priority, bus_address, func, *args):
+        return self._scheduler.submit(priority, self._bus_key(bus_address), func, *args)
+
     def select_bus_address(self, bus_address, force=False):
+        # Anything queued was addressed before the switch
+        self._batch_flush()
+        self._submit(self.PRIORITY.CONTROL, bus_address, self._select_bus_address, bus_address, force).result()
+
+    def _select_bus_address(self, bus_address, force=False):
         if self._use_bus_address and bus_address is not None:
             if force or self._last_bus_address != bus_address:
                 self._logger.debug("{} Select bus address {}".format(self.get_address(), bus_address))
                 self._instrument.write("*ADR {}".format(bus_address))
 
                 self._last_bus_address = bus_address
-                
-                # Wait
-                time.sleep(0.5)
+                self._bus_switches += 1
 
-    def write(self, data, bus_address=None):
-        self.select_bus_address(bus_address)
+                self._bus_settle()
+
+    def _bus_settle(self):
+        if not self._bus_settle_probe:
+            time.sleep(self._BUS_SETTLE_TIME)
+            return
+
+        # Wait for the newly addressed device to answer rather than sleeping for a fixed time
+        orig_timeout = self._instrument.timeout
+        self._instrument.timeout = int(self._BUS_SETTLE_TIME * 1000)
+
+        settle_start = time.time()
+
+        try:
+            self._instrument.query("*OPC?")
+        except:
+            self._logger.warning("{} No response after bus address change, using fixed {} sec delay".format(
+                self.get_address(), self._BUS_SETTLE_TIME))
+
+            self._bus_settle_probe = False
+            self._instrument.clear()
+
+            time.sleep(max(0, self._BUS_SETTLE_TIME - (time.time() - settle_start)))
+            return
+        finally:
+            self._instrument.timeout = orig_timeout
+
+        settle_time = time.time() - settle_start
+
+        if self._bus_settle_time is None:
+            self._bus_settle_time = settle_time
+        else:
+            self._bus_settle_time = 0.8 * self._bus_settle_time + 0.2 * settle_time
+
+        self._logger.debug("{} Bus settled after {:.3f} sec".format(self.get_address(), settle_time))
+
+    def device_clear(self, priority=InstrumentConnector.PRIORITY.CONTROL):
+        self._batch_flush()
+        self._submit(priority, None, self._device_clear).result()
+
+    def _device_clear(self):
+        self._logger.debug("{} CLEAR".format(self.get_address()))
+        self._instrument.clear()
+
+    def write(self, data, bus_address=None, priority=InstrumentConnector.PRIORITY.CONTROL):
+        if not self._batch_append(data, bus_address):
+            self._write(data, bus_address, priority)
+
+    def write_async(self, data, bus_address=None, priority=InstrumentConnector.PRIORITY.CONTROL):
+        self._batch_flush()
+        return self._submit(priority, bus_address, self._write_direct, data, bus_address)
+
+    def _write(self, data, bus_address, priority=InstrumentConnector.PRIORITY.CONTROL):
+        self._submit(priority, bus_address, self._write_direct, data, bus_address).result()
+
+    def _write_direct(self, data, bus_address):
+        self._select_bus_address(bus_address)
         self._logger.debug("{} WRITE: {}".format(self.get_address(), data))
 
         self._instrument.write(data)
         
-    def write_raw(self, data, raw_data, bus_address=None):
-        self.select_bus_address(bus_address)
+    def write_raw(self, data, raw_data, bus_address=None, priority=InstrumentConnector.PRIORITY.BULK):
+        self._batch_flush()
+        self._submit(priority, bus_address, self._write_raw, data, raw_data, bus_address).result()
+
+    def _write_raw(self, data, raw_data, bus_address):
+        self._select_bus_address(bus_address)
         self._logger.debug("{} WRITE RAW: {}({} bytes)".format(self.get_address(), data, len(raw_data)))
 
         self._instrument.write_binary_values(data, raw_data, datatype='c')
 
-    def query(self, data, bus_address=None, timeout=False):
+    def query(self, data, bus_address=None, timeout=False, priority=InstrumentConnector.PRIORITY.STATE):
+        return self.query_async(data, bus_address, timeout, priority).result()
+
+    def query_async(self, data, bus_address=None, timeout=False, priority=InstrumentConnector.PRIORITY.STATE):
+        data = self._batch_prefix(bus_address) + data
+        return self._submit(priority, bus_address, self._query, data, bus_address, timeout)
+
+    def _query(self, data, bus_address, timeout):
         orig_timeout = self._instrument.timeout
 
         if type(timeout) is not bool:
             self._instrument.timeout = timeout
 
-        self.select_bus_address(bus_address)
+        self._select_bus_address(bus_address)
         self._logger.debug("{} QUERY: {}".format(self.get_address(), data))
 
         response = self._instrument.query(data)
@@ -91,13 +512,20 @@ class VISAConnector(InstrumentConnector):
         self._instrument.timeout = orig_timeout
         return response
 
-    def query_raw(self, data, bus_address=None, timeout=None):
+    def query_raw(self, data, bus_address=None, timeout=None, priority=InstrumentConnector.PRIORITY.BULK):
+        return self.query_raw_async(data, bus_address, timeout, priority).result()
+
+    def query_raw_async(self, data, bus_address=None, timeout=None, priority=InstrumentConnector.PRIORITY.BULK):
+        data = self._batch_prefix(bus_address) + data
+        return self._submit(priority, bus_address, self._query_raw, data, bus_address, timeout)
+
+    def _query_raw(self, data, bus_address, timeout):
         orig_timeout = self._instrument.timeout
 
         if timeout is not None:
             self._instrument.timeout = timeout
 
-        self.select_bus_address(bus_address)
+        self._select_bus_address(bus_address)
         self._logger.debug("{} QUERY: {}".format(self.get_address(), data))
 
         self._instrument.write(data)
@@ -110,18 +538,266 @@ class VISAConnector(InstrumentConnector):
         self._instrument.timeout = orig_timeout
         return response
 
+    def query_block(self, data, bus_address=None, timeout=None, expect_termination=True,
+                    priority=InstrumentConnector.PRIORITY.BULK):
+        """Query an IEEE 488.2 binary block, the payload is returned as a bytearray without the block header"""
+        return self.query_block_async(data, bus_address, timeout, expect_termination, priority).result()
+
+    def query_block_async(self, data, bus_address=None, timeout=None, expect_termination=True,
+                          priority=InstrumentConnector.PRIORITY.BULK):
+        data = self._batch_prefix(bus_address) + data
+        return self._submit(priority, bus_address, self._query_block, data, bus_address, timeout,
+                            expect_termination)
+
+    def _query_block(self, data, bus_address, timeout, expect_termination):
+        orig_timeout = self._instrument.timeout
+
+        if timeout is not None:
+            self._instrument.timeout = timeout
+
+        self._select_bus_address(bus_address)
+        self._logger.debug("{} QUERY: {}".format(self.get_address(), data))
+
+        try:
+            self._instrument.write(data)
+            response = self._read_block(expect_termination)
+        finally:
+            self._instrument.timeout = orig_timeout
+
+        response_len = len(response)
+        self._logger.debug("{} RESPONSE: {} byte block".format(self.get_address(), response_len))
+
+        return response
+
+    def _read_block(self, expect_termination):
+        if self._instrument.read_bytes(1) != '#':
+            raise InstrumentException('Invalid binary block header')
+
+        header_len = int(self._instrument.read_bytes(1))
+
+        if header_len == 0:
+            # Indefinite length block, payload runs until the end of the message and only the terminator is removed
+            response = bytearray(self._instrument.read_raw())
+            terminator = self._term_chars or '\n'
+
+            if response.endswith(terminator):
+                del response[len(response) - len(terminator):]
+
+            return response
+
+        response_len = int(self._instrument.read_bytes(header_len))
+        response = bytearray(response_len)
+
+        # Fill the buffer chunk by chunk so the payload is only copied once
+        offset = 0
+
+        while offset < response_len:
+            chunk = self._instrument.read_bytes(min(self._BLOCK_CHUNK_SIZE, response_len - offset))
+            response[offset:offset + len(chunk)] = chunk
+            offset += len(chunk)
+
+        # Discard the message terminator following the block
+        if expect_termination:
+            self._instrument.read_raw()
+
+        return response
+
+
+class ConnectorRegistry:
+    """Shared VISA connectors, one per resource address"""
+    def __init__(self):
+        self._logger = logging.getLogger(__name__)
+        self._lock = threading.Lock()
+
+        # Address mapped to [connector, reference count]
+        self._connectors = {}
+
+    def open(self, address, term_chars=None, use_bus_address=False):
+        with self._lock:
+            if address in self._connectors:
+                entry = self._connectors[address]
+                connector = entry[0]
+
+                if connector.get_term_chars() != term_chars or connector.is_bus_addressed() != use_bus_address:
+                    raise InstrumentException("{} already open with different settings".format(address))
+
+                entry[1] += 1
+                self._logger.debug("{} Shared connector ({} users)".format(address, entry[1]))
+
+                return connector
+
+            connector = VISAConnector(address, term_chars, use_bus_address)
+            self._connectors[address] = [connector, 1]
+
+            return connector
+
+    def release(self, connector):
+        with self._lock:
+            address = connector.get_address()
+            entry = self._connectors.get(address)
+
+            if entry is None or entry[0] is not connector:
+                raise InstrumentException("{} is not a registered connector".format(address))
+
+            entry[1] -= 1
+
+            if entry[1] > 0:
+                return
+
+            del self._connectors[address]
+
+        connector.close()
+
+    def get_open(self):
+        with self._lock:
+            return {address: entry[1] for address, entry in self._connectors.iteritems()}
+
+
+registry = ConnectorRegistry()
+
 
 """Base class for all instruments"""
 class Instrument:
+    # IEEE 488.2 status byte and standard event status register bits
+    STATUS = util.enum(MAV=16, ESB=32, RQS=64)
+    EVENT_STATUS = util.enum(OPC=1, QYE=4, DDE=8, EXE=16, CME=32, PON=128)
+
+    # Completion polling interval limits when service requests are not available
+    _POLL_INTERVAL_MIN = 0.002
+    _POLL_INTERVAL_MAX = 0.1
+    _SRQ_WAIT = 1.0
+
+    # Data format commands used by _set_binary_format()
+    _FORMAT_REAL = ":FORM REAL,64"
+    _FORMAT_ASCII = ":FORM ASC"
+
     def __init__(self, connector, bus_address=False):
         self._connector = connector
         self._bus_address = bus_address
 
+        self._logger = logging.getLogger(__name__)
+
+        # Workers started by run_async() and completion waits, keyed by name
+        self._executors = {}
+
+        # Shadow copy of settings written to the instrument, None while caching is disabled
+        self._settings_cache = None
+        self._settings_cache_hits = 0
+        self._settings_cache_misses = 0
+
+        # Data transfers start as text, binary transfers are enabled on first use
+        self._binary_format = False
+
+    def get_connector(self):
+        return self._connector
+
+    def run_async(self, func, *args, **kwargs):
+        """Run an instrument method on this instrument's worker thread, returns a util.Future
+
+        Calls for one instrument run in order, calls to different instruments run concurrently."""
+        return self._get_executor("Instrument").submit(func, *args, **kwargs)
+
+    def _get_executor(self, name):
+        # Workers are started on first use and end when the connector is closed
+        with _executor_lock:
+            if name not in self._executors:
+                self._executors[name] = util.Executor("{} {}".format(name, self._connector.get_address()))
+                self._connector.add_executor(self._executors[name])
+
+            return self._executors[name]
+
+    def wait_measurement_async(self, timeout=None):
+        """Wait for pending operations to complete, returns a util.Future"""
+        with self.batch():
+            self._write_setting("*ESE", self.EVENT_STATUS.OPC)
+            self._write_setting("*SRE", self.STATUS.ESB)
+            self._connector.write("*CLS", self._bus_address)
+            self._connector.write("*OPC", self._bus_address)
+
+        return self._completion_future(lambda: bool(self.get_event_status() & self.EVENT_STATUS.OPC), timeout)
+
+    def _completion_future(self, check, timeout=None, poll_max=None):
+        """Complete a future once check() returns True
+
+        check() is called on each service request, or with exponential backoff if service requests are not
+        available."""
+        self._connector.enable_srq()
+
+        # Waits for one instrument share a worker, the timeout counts from the request
+        return self._get_executor("Wait").submit(self._completion_wait, check, time.time(), timeout, poll_max)
+
+    def _completion_wait(self, check, start_time, timeout, poll_max):
+        poll_interval = self._POLL_INTERVAL_MIN
+        poll_max = poll_max or self._POLL_INTERVAL_MAX
+
+        while not check():
+            if timeout is None:
+                wait_time = self._SRQ_WAIT
+            else:
+                wait_time = timeout - (time.time() - start_time)
+
+                if wait_time <= 0:
+                    raise InstrumentTimeoutException("{} operation did not complete within {} sec".format(
+                        self._connector.get_address(), timeout))
+
+                wait_time = min(self._SRQ_WAIT, wait_time)
+
+            if self._connector.wait_srq(wait_time) is None:
+                time.sleep(min(poll_interval, wait_time))
+                poll_interval = min(2 * poll_interval, poll_max)
+
+        return True
+
+    @contextlib.contextmanager
+    def batch(self):
+        try:
+            with self._connector.batch():
+                yield
+        except:
+            # Settings cached in a dropped or failed batch may never have been applied
+            self.invalidate_settings()
+            raise
+
+    def set_settings_cache(self, enabled):
+        self._settings_cache = {} if enabled else None
+
+    def get_settings_cache_stats(self):
+        return self._settings_cache_hits, self._settings_cache_misses
+
+    def invalidate_settings(self):
+        if self._settings_cache is not None:
+            self._settings_cache.clear()
+
+    def _invalidate_setting(self, header):
+        if self._settings_cache is not None:
+            self._settings_cache.pop(header, None)
+
+    def _write_setting(self, header, value):
+        """Write a setting command, returns False if the cache shows the value is already applied"""
+        if self._settings_cache is not None:
+            if header in self._settings_cache and self._settings_cache[header] == value:
+                self._settings_cache_hits += 1
+                return False
+
+            self._settings_cache_misses += 1
+
+        try:
+            self._connector.write("{} {}".format(header, value), self._bus_address)
+        except:
+            # Instrument state is unknown after a failed write
+            self.invalidate_settings()
+            raise
+
+        if self._settings_cache is not None:
+            self._settings_cache[header] = value
+
+        return True
+
     def clear(self):
         self._connector.write("*CLS", self._bus_address)
 
     def get_event_status_enable(self):
-        return int(self._connector.ask("*ESE?", self._bus_address))
+        return int(self._connector.query("*ESE?", self._bus_address))
 
     def get_event_status_opc(self):
         return bool(self._connector.query("*OPC?", self._bus_address))
@@ -130,10 +806,10 @@ class Instrument:
         return bool(self._connector.query("*SRE?", self._bus_address))
 
     def get_status(self):
-        return bool(self._connector.query("*STB?", self._bus_address))
+        return int(self._connector.query("*STB?", self._bus_address))
 
     def get_event_status(self):
-        return int(self._connector.ask("*ESR?", self._bus_address))
+        return int(self._connector.query("*ESR?", self._bus_address))
 
     def set_event_status_enable(self, mask):
         self._connector.write("*ESE {}".format(mask), self._bus_address)
@@ -151,6 +827,8 @@ class Instrument:
         return self._connector.query("*OPT?", self._bus_address)
 
     def reset(self):
+        self.invalidate_settings()
+        self._binary_format = False
         self._connector.write("*RST")
 
         # Some equipment must be re-addressed after a reset
@@ -162,8 +840,22 @@ class Instrument:
     def wait(self):
         self._connector.write("*WAI", self._bus_address)
 
-    def wait_measurement(self):
-        self._connector.query("*OPC?", self._bus_address, timeout=None)
+    def wait_measurement(self, timeout=None):
+        self.wait_measurement_async(timeout).result()
+
+    def _set_binary_format(self, enabled):
+        # REAL transfers are 64-bit floats, swapped byte order makes them little-endian
+        if enabled == self._binary_format:
+            return
+
+        if enabled:
+            with self.batch():
+                self._connector.write(self._FORMAT_REAL)
+                self._connector.write(":FORM:BORD SWAP")
+        else:
+            self._connector.write(self._FORMAT_ASCII)
+
+        self._binary_format = enabled
 
     @staticmethod
     def _cast_bool(value):
@@ -179,32 +871,162 @@ class InstrumentException(Exception):
         return self.value
 
 
+class InstrumentTimeoutException(InstrumentException):
+    """ Operation did not complete in time"""
+    pass
+
+
 """Instrument definitions"""
 
 
+class WaveformPreamble:
+    """Parsed oscilloscope waveform preamble"""
+    def __init__(self, header):
+        self.format = int(header[0])
+        self.type = int(header[1])
+        self.points = int(header[2])
+        self.count = int(header[3])
+        self.x_increment = float(header[4])
+        self.x_origin = float(header[5])
+        self.x_reference = int(header[6])
+        self.y_increment = float(header[7])
+        self.y_origin = float(header[8])
+        self.y_reference = int(header[9])
+
+
 class FrequencyCounter(Instrument):
     INPUT_IMPEDANCE = util.enum(FIFTY='50', HIGH='1E6')
     AVERAGE_TYPE = util.enum(MIN='MIN', MAX='MAX', MEAN='MEAN', STD_DEVIATION='SDEV')
 
+    # Maximum sample and trigger count, continuous acquisition runs until aborted
+    _STREAM_COUNT = 1000000
+
     def __init__(self, connector, bus_address=False):
         Instrument.__init__(self, connector, bus_address)
 
         self._average = False
 
+        # Readings per trigger
+        self._sample_count = 1
+        self._sample_interval = None
+        self._timestamps = False
+
+        # Buffer set by setup_buffer(), restored by read_buffer() after single readings or streaming
+        self._buffer_setup = (1, None, False)
+
+    def reset(self):
+        Instrument.reset(self)
+
+        self._average = False
+        self._sample_count = 1
+        self._sample_interval = None
+        self._timestamps = False
+        self._buffer_setup = (1, None, False)
+
     def trigger(self):
         self._connector.write(":INIT")
 
     def get_frequency(self):
+        # Single readings are returned as text
+        if self._sample_count != 1:
+            self._setup_buffer(1, None, False)
+
+        self._set_binary_format(False)
+
         if self._average:
             return float(self._connector.query(":CALC:DATA?"))
         else:
             return float(self._connector.query(":READ?"))
 
+    def setup_buffer(self, count, interval=None, timestamps=False):
+        """Take count readings per trigger, started every interval seconds or back to back if interval is None"""
+        self._buffer_setup = (count, interval, timestamps)
+        self._setup_buffer(count, interval, timestamps)
+
+    def _setup_buffer(self, count, interval, timestamps):
+        with self.batch():
+            self._write_setting(":TRIG:COUN", 1)
+            self._write_setting(":SAMP:COUN", count)
+
+            if interval is None:
+                self._write_setting(":SAMP:SOUR", "IMM")
+            else:
+                self._write_setting(":SAMP:SOUR", "TIM")
+                self._write_setting(":SAMP:TIM", interval)
+
+            self._write_setting(":FORM:TINF", self._cast_bool(timestamps))
+
+        self._sample_count = count
+        self._sample_interval = interval
+        self._timestamps = timestamps
+
+    def get_frequency_buffer(self):
+        """Fetch all readings of the last trigger, returns (frequency, timestamp) arrays
+
+        Timestamps are seconds from the instrument, None unless enabled by setup_buffer()."""
+        self._set_binary_format(True)
+
+        return self._parse_readings(self._connector.query_block(":FETC?"))
+
+    def read_buffer(self, timeout=None):
+        if (self._sample_count, self._sample_interval, self._timestamps) != self._buffer_setup:
+            self._setup_buffer(*self._buffer_setup)
+
+        self.trigger()
+        self.wait_measurement(timeout)
+
+        return self.get_frequency_buffer()
+
+    def start_stream(self, gap_free=False):
+        """Acquire continuously into reading memory, readings are collected with read_stream()
+
+        Gap free measurements are only available on counters that support the continuous frequency mode."""
+        with self.batch():
+            if gap_free:
+                self._write_setting(":FREQ:MODE", "CONT")
+
+            self._write_setting(":SAMP:SOUR", "IMM")
+            self._write_setting(":SAMP:COUN", self._STREAM_COUNT)
+            self._write_setting(":TRIG:COUN", self._STREAM_COUNT)
+            self._write_setting(":FORM:TINF", self._cast_bool(True))
+
+        # Single readings reconfigure the counter
+        self._sample_count = None
+        self._sample_interval = None
+        self._timestamps = True
+
+        self.trigger()
+
+    def read_stream(self, max_count=None):
+        """Remove the available readings from memory, returns (frequency, timestamp) arrays"""
+        self._set_binary_format(True)
+
+        if max_count is None:
+            return self._parse_readings(self._connector.query_block("R?"))
+        else:
+            return self._parse_readings(self._connector.query_block("R? {}".format(max_count)))
+
+    def stop_stream(self):
+        self._connector.write(":ABOR")
+
+    def _parse_readings(self, buf):
+        data = numpy.frombuffer(buf, dtype='<f8', count=len(buf) // 8)
+
+        if self._timestamps:
+            # Each reading is followed by its timestamp
+            data = data.reshape(-1, 2)
+            return data[:, 0], data[:, 1]
+
+        return data, None
+
+    def get_frequency_async(self):
+        return self.run_async(self.get_frequency)
+
     def set_measurement_time(self, secs):
-        self._connector.write(":ACQ:APER {}".format(secs))
+        self._write_setting(":ACQ:APER", secs)
 
     def set_impedance(self, impedance):
-        self._connector.write(":INP:IMP {}".format(impedance))
+        self._write_setting(":INP:IMP", impedance)
 
     def set_calculate_average(self, enabled, average_type=None, count=128):
         if enabled and count > 1 and average_type is not None:
@@ -223,19 +1045,57 @@ class NetworkAnalyzer(Instrument):
     CAL_TYPE = util.enum(OPEN='OPEN', SHORT='SHOR', LOAD='LOAD', THROUGH='THRU', ISOLATION='ISOL')
     SNP_FORMAT = util.enum(AUTO='AUTO', LOGMAG_ANG='MA', LINMAG_ANG='DB', REAL_IMAG='RI')
 
+    # Volatile channel state registers and window layouts for up to 4 channels
+    CHANNEL_REGISTER = ['A', 'B', 'C', 'D']
+    _CHANNEL_LAYOUT = ['D1', 'D12', 'D123', 'D12_34']
+
+    _FORMAT_REAL = ":FORM:DATA REAL"
+    _FORMAT_ASCII = ":FORM:DATA ASC"
+
     def __init__(self, connector):
         Instrument.__init__(self, connector, False)
 
     def trigger(self):
         # Select manual as trigger source so wait_measurement() will work properly
-        self._connector.write(":TRIG:SOUR MAN")
-        self._connector.write(":TRIG:SING")
+        with self.batch():
+            self._connector.write(":TRIG:SOUR MAN")
+            self._connector.write(":TRIG:SING")
 
     def trigger_single(self, channel=1):
         # Setup for single measurement
         self._connector.write(":INIT{}".format(channel))
         self.trigger()
 
+    def trigger_all(self, channel_count):
+        # One trigger sweeps every channel in turn
+        with self.batch():
+            self._connector.write(":TRIG:SCOP ALL")
+
+            for channel in range(1, channel_count + 1):
+                self._connector.write(":INIT{}:CONT ON".format(channel))
+
+        self.trigger()
+
+    def set_channel_count(self, channel_count):
+        if channel_count < 1 or channel_count > len(self._CHANNEL_LAYOUT):
+            raise InstrumentException("Unsupported number of channels")
+
+        self._connector.write(":DISP:SPL {}".format(self._CHANNEL_LAYOUT[channel_count - 1]))
+
+    def channel_store(self, register, channel=1):
+        """Save the settings of a channel to a volatile channel state register"""
+        with self.batch():
+            self._connector.write(":DISP:WIND{}:ACT".format(channel))
+            self._connector.write(":MMEM:STOR:CHAN {}".format(register))
+
+    def channel_recall(self, register, channel=1):
+        """Replace the settings of a channel with those saved in a channel state register"""
+        with self.batch():
+            self._connector.write(":DISP:WIND{}:ACT".format(channel))
+            self._connector.write(":MMEM:LOAD:CHAN {}".format(register))
+
+        self.invalidate_settings()
+
     def cal_calculate(self, channel=1):
         self._connector.write(":SENS{}:CORR:COLL:SAVE".format(channel))
 
@@ -269,28 +1129,60 @@ class NetworkAnalyzer(Instrument):
         if port_count < 1 or port_count > 4:
             raise InstrumentException("Unsupported number of ports in SNP format")
 
-        self._connector.write(":MMEM:STOR:SNP:TYPE:S{}P {}".format(port_count, ','.join(str(x) for x in ports)))
-        self._connector.write(":MMEM:STOR:SNP:FORM {}".format(snp_format))
-        self._connector.write(":MMEM:STOR:SNP \"{}\"".format(path))
+        with self.batch():
+            self._connector.write(":MMEM:STOR:SNP:TYPE:S{}P {}".format(port_count, ','.join(str(x) for x in ports)))
+            self._connector.write(":MMEM:STOR:SNP:FORM {}".format(snp_format))
+            self._connector.write(":MMEM:STOR:SNP \"{}\"".format(path))
+
+    # Direct data readout
+    def setup_sparameters(self, ports, channel=1):
+        """Define a trace for each S-parameter between ports, numbered in row-major order"""
+        with self.batch():
+            self._connector.write(":CALC{}:PAR:COUN {}".format(channel, len(ports) ** 2))
+
+            for n, (i, j) in enumerate((i, j) for i in ports for j in ports):
+                self._connector.write(":CALC{}:PAR{}:DEF S{}{}".format(channel, n + 1, i, j))
+
+    def get_frequency_data(self, channel=1):
+        return self._read_real(":SENS{}:FREQ:DATA?".format(channel))
+
+    def get_sparameters(self, ports, channel=1):
+        """Read corrected data for traces defined by setup_sparameters() as a (points, ports, ports) array"""
+        port_count = len(ports)
+        data = None
+
+        for n in range(port_count ** 2):
+            trace = self._read_real(":CALC{0}:PAR{1}:SEL;:CALC{0}:SEL:DATA:SDAT?".format(channel, n + 1))
+            trace = trace.view(numpy.complex128)
+
+            if data is None:
+                data = numpy.empty((len(trace), port_count, port_count), dtype=numpy.complex128)
+
+            data[:, n // port_count, n % port_count] = trace
+
+        return data
+
+    def get_impedance(self, channel=1):
+        return float(self._connector.query(":SENS{}:CORR:IMP?".format(channel)))
+
+    def _read_real(self, query):
+        self._set_binary_format(True)
+
+        buf = self._connector.query_block(query)
+
+        return numpy.frombuffer(buf, dtype='<f8', count=len(buf) // 8)
 
     def lock(self, key_lock=False, mouse_lock=False, backlight=False):
-        self._connector.write(":SYST:KLOC:KBD {}".format(self._cast_bool(not key_lock)))
-        self._connector.write(":SYST:KLOC:MOUS {}".format(self._cast_bool(not mouse_lock)))
-        self._connector.write(":SYST:BACK {}".format(self._cast_bool(not backlight)))
+        with self.batch():
+            self._connector.write(":SYST:KLOC:KBD {}".format(self._cast_bool(not key_lock)))
+            self._connector.write(":SYST:KLOC:MOUS {}".format(self._cast_bool(not mouse_lock)))
+            self._connector.write(":SYST:BACK {}".format(self._cast_bool(not backlight)))
 
     def file_delete(self, path):
         self._connector.write(":MMEM:DEL \"{}\"".format(path))
 
     def file_read(self, path):
-        data = self._connector.query_raw(":MMEM:TRAN? \"{}\"".format(path))
-
-        if data[0] != '#':
-            return ''
-
-        data_start = 2 + int(data[1])
-        data_size = int(data[2:data_start])
-
-        return data[data_start:(data_start + data_size)]
+        return self._connector.query_block(":MMEM:TRAN? \"{}\"".format(path))
 
     def file_write(self, path, data):
         # size = len(data)
@@ -311,6 +1203,10 @@ class NetworkAnalyzer(Instrument):
     def state_load(self, path):
         self._connector.write(":MMEM:LOAD \"{}\"".format(path))
 
+        # Loaded state replaces all settings
+        self.invalidate_settings()
+        self._binary_format = False
+
     def state_save(self, path):
         self._connector.write(":MMEM:STOR \"{}\"".format(path))
 
@@ -333,6 +1229,9 @@ class NetworkAnalyzer(Instrument):
             else:
                 err_list.extend(err)
 
+        if err_list:
+            self.invalidate_settings()
+
         return err_list
 
     def is_ready(self):
@@ -341,8 +1240,22 @@ class NetworkAnalyzer(Instrument):
 
 class Oscilloscope(Instrument):
     _TIMEOUT_DEFAULT = 5.0
+
+    # Status byte bit summarising the trigger event register
+    STATUS_TRIGGER = 1
+
+    # Measurement results at or above this value mean no result could be measured
+    _MEASUREMENT_INVALID = 9.9e37
+
+    # Reference waveform memories available for pipelined captures
+    _WAVE_MEM_COUNT = 2
     _VOLTAGE_STEPS = [5e-3, 1e-2, 2e-2, 5e-2, 1e-1, 2e-1, 5e-1, 1e0]
 
+    # Autoranging aims for the signal peak at this fraction of half the screen, clipping steps up at least this far
+    _AUTORANGE_FILL = 0.8
+    _AUTORANGE_CLIP_STEPS = 2
+    _CODE_CENTER = 128
+
     ALL_CHANNELS = 0
 
     CHANNEL_COUPLING = util.enum(AC='AC', DC='DC')
@@ -359,19 +1272,48 @@ class Oscilloscope(Instrument):
     TRIGGER_POLARITY = util.enum(POSITIVE='POS', NEGATIVE='NEG', EITHER='EITH', ALTERNATE='ALT')
     TRIGGER_QUALIFIER = util.enum(GREATER='GRE', LESSER='LESS', RANGE='RANG')
     WAVEFORM_FORMAT = util.enum(BYTE='BYTE', WORD='WORD')
+    WAVEFORM_POINTS_MODE = util.enum(NORMAL='NORM', MAXIMUM='MAX', RAW='RAW')
+    MEASUREMENT = util.enum(AMPLITUDE='VAMP', PEAK_TO_PEAK='VPP', AVERAGE='VAV', RMS='VRMS', MAXIMUM='VMAX',
+                            MINIMUM='VMIN', TOP='VTOP', BASE='VBAS', RISE_TIME='RIS', FALL_TIME='FALL',
+                            FREQUENCY='FREQ', PERIOD='PER', POSITIVE_WIDTH='PWID', NEGATIVE_WIDTH='NWID',
+                            DELAY='DEL', PHASE='PHAS', OVERSHOOT='OVER')
     WAVEFORM_SOURCE = util.enum(CHANNEL='CHAN', POD='POD', BUS='BUS', FUNCTION='FUNC', MATH='MATH', WAVE_MEM='WMEM',
                                 SBUS='SBUS')
 
+    _WAVEFORM_POINTS_DEFAULT = 200000
+    _TIME_DIVISIONS = 10
+
+    # Ideal quantisation SNR of BYTE data (6.02 * bits + 1.76 dB), anything more needs WORD
+    _WAVEFORM_BYTE_SNR = 49.9
+
+    _WAVEFORM_DTYPE = {
+        WAVEFORM_FORMAT.BYTE: numpy.dtype(numpy.uint8),
+        WAVEFORM_FORMAT.WORD: numpy.dtype('<u2')
+    }
+
     def __init__(self, connector, channels=4):
         Instrument.__init__(self, connector, False)
 
         self._channels = channels
         self._smart_ready = False
-        self._channel_v_cache = []
+        self._channel_v_cache = {}
         self._waveform_format = self.WAVEFORM_FORMAT.BYTE
+        self._bytes_transferred = 0
+
+        # Parsed preambles keyed by waveform source, cleared whenever scaling or timebase settings change
+        self._preamble_cache = {}
+        self._time_axis_cache = {}
+
+        self._segment_bulk = True
+
+    def reset(self):
+        Instrument.reset(self)
+        self._invalidate_preamble()
 
     def setup_auto(self):
         self._connector.write(":AUT")
+        self.invalidate_settings()
+        self._invalidate_preamble()
 
     def setup_default(self):
         self.reset()
@@ -382,6 +1324,8 @@ class Oscilloscope(Instrument):
 
         if count > 0:
             self._connector.write(":ACQ:COUN {}".format(count))
+
+        self._invalidate_preamble()
     
     # Segmented memory functions
     def set_segment_count(self, count=1):
@@ -391,34 +1335,39 @@ class Oscilloscope(Instrument):
         else:
             self._connector.write(':ACQ:MODE RTIM')
 
+        self._invalidate_preamble()
+
     # Channel configuration
     def set_channel_atten(self, channel, attenuation):
-        self._connector.write(":CHAN{}:PROB {}".format(channel, attenuation))
+        if self._write_setting(":CHAN{}:PROB".format(channel), attenuation):
+            self._invalidate_preamble()
 
     def set_channel_coupling(self, channel, coupling):
-        self._connector.write(":CHAN{}:COUP {}".format(channel, coupling))
+        self._write_setting(":CHAN{}:COUP".format(channel), coupling)
 
     def set_channel_enable(self, channel=ALL_CHANNELS, enabled=False):
         if channel == 0:
             for n in range(1, (self._channels + 1)):
-                self._connector.write(":CHAN{}:DISP {}".format(n, self._cast_bool(enabled)))
+                self._write_setting(":CHAN{}:DISP".format(n), self._cast_bool(enabled))
         else:
-            self._connector.write(":CHAN{}:DISP {}".format(channel, self._cast_bool(enabled)))
+            self._write_setting(":CHAN{}:DISP".format(channel), self._cast_bool(enabled))
 
     def set_channel_label(self, channel, label):
-        self._connector.write(":CHAN{}:LAB \"{}\"".format(channel, label))
+        self._write_setting(":CHAN{}:LAB".format(channel), "\"{}\"".format(label))
 
     def set_channel_label_visible(self, visible):
-        self._connector.write(":DISP:LAB {}".format(self._cast_bool(visible)))
+        self._write_setting(":DISP:LAB", self._cast_bool(visible))
 
     def set_channel_offset(self, channel, offset):
-        self._connector.write(":CHAN{}:OFFS {}".format(channel, offset))
+        if self._write_setting(":CHAN{}:OFFS".format(channel), offset):
+            self._invalidate_preamble()
 
     def set_channel_scale(self, channel, scale):
-        self._connector.write(":CHAN{}:SCAL {}".format(channel, scale))
+        if self._write_setting(":CHAN{}:SCAL".format(channel), scale):
+            self._invalidate_preamble()
 
     def set_channel_impedance(self, channel, impedance):
-        self._connector.write(":CHAN{}:IMP {}".format(channel, impedance))
+        self._write_setting(":CHAN{}:IMP".format(channel), impedance)
 
     # Run state
     def set_run_state(self, state):
@@ -433,37 +1382,44 @@ class Oscilloscope(Instrument):
 
     # Timebase
     def set_time_mode(self, mode):
-        self._connector.write(":TIM:MODE {}".format(mode))
+        if self._write_setting(":TIM:MODE", mode):
+            self._invalidate_preamble()
 
     def set_time_offset(self, secs):
-        self._connector.write(":TIM:POS {}".format(secs))
+        if self._write_setting(":TIM:POS", secs):
+            self._invalidate_preamble()
 
     def set_time_reference(self, reference):
-        self._connector.write(":TIM:REF {}".format(reference))
+        if self._write_setting(":TIM:REF", reference):
+            self._invalidate_preamble()
 
     def set_time_scale(self, secs_per_div):
-        self._connector.write(":TIM:SCAL {}".format(secs_per_div))
+        if self._write_setting(":TIM:SCAL", secs_per_div):
+            self._invalidate_preamble()
 
     # Trigger
     def set_trigger_holdoff(self, secs):
-        self._connector.write(":TRIG:HOLD {}".format(secs))
+        self._write_setting(":TRIG:HOLD", secs)
 
     def set_trigger_mode(self, mode):
-        self._connector.write(":TRIG:MODE {}".format(mode))
+        self._write_setting(":TRIG:MODE", mode)
 
     def set_trigger_sweep(self, sweep):
-        self._connector.write(":TRIG:SWE {}".format(sweep))
+        self._write_setting(":TRIG:SWE", sweep)
 
     def set_trigger_edge_level(self, level, polarity=TRIGGER_POLARITY.POSITIVE):
-        self._connector.write(":TRIG:SLOP {}".format(polarity))
-        self._connector.write(":TRIG:LEV {}".format(level))
+        self._write_setting(":TRIG:SLOP", polarity)
+        self._write_setting(":TRIG:LEV", level)
 
     def set_trigger_edge_level_auto(self, polarity=TRIGGER_POLARITY.POSITIVE):
-        self._connector.write(":TRIG:SLOP {}".format(polarity))
+        self._write_setting(":TRIG:SLOP", polarity)
         self._connector.write(":TRIG:LEV:ASET")
 
+        # Level is now chosen by the scope
+        self._invalidate_setting(":TRIG:LEV")
+
     def set_trigger_edge_source(self, source, channel=-1):
-        self._connector.write(":TRIG:EDGE:SOUR {}{}".format(source, channel if channel >= 0 else ''))
+        self._write_setting(":TRIG:EDGE:SOUR", "{}{}".format(source, channel if channel >= 0 else ''))
 
     def set_trigger_glitch_range(self, minimum=0, maximum=0):
         if min > 0:
@@ -483,142 +1439,249 @@ class Oscilloscope(Instrument):
         self._connector.write(":TRIG:GLIT:LEV {}".format(level))
 
     def trigger_single(self, timeout=0.0, interval=0.1):
+        try:
+            return self.trigger_single_async(timeout, interval).result()
+        except InstrumentTimeoutException:
+            raise InstrumentTimeoutException('Oscilloscope trigger timeout')
+
+    def trigger_single_async(self, timeout=0.0, interval=0.1):
+        """Arm a single acquisition, the returned future completes on the trigger event"""
         # self._connector.write(":ACQ:SRAT:ANAL 500E+6")
         # self._connector.write(":ACQ:POIN:ANAL 200000")
-    
-        # Stop capture and clear trigger event register
-        self._connector.write(":STOP")
-        self._connector.query(":TER?")
-        self._connector.write(":DIG")
-        # self._connector.write(":SING")
-
-        t = 0
-
-        while timeout == 0 or t <= timeout:
-            trigger = self._connector.query(":TER?")
-
-            if len(trigger) > 0 and trigger[1] == '1':
-                return True
 
+        # Stop capture and clear trigger event register, the trigger bit then requests service
+        with self.batch():
+            self._connector.write(":STOP")
+            self._connector.query(":TER?")
+            self._write_setting("*SRE", self.STATUS_TRIGGER)
             self._connector.write(":SING")
 
-            time.sleep(interval)
+        return self._completion_future(self._get_trigger_event, timeout or None, interval)
 
-            t += interval
+    def _get_trigger_event(self):
+        trigger = self._connector.query(":TER?")
 
-        raise InstrumentException('Oscilloscope trigger timeout')
+        # Response is terminated by a newline
+        return trigger.strip().endswith('1')
 
     # Data capture commands
     def save_image(self, path, image_format=IMAGE_FORMAT.PNG, setup=False, color=True):
-        self._connector.write(":SAVE:IMAG:FIL \"{}\"".format(path))
-        self._connector.write(":SAVE:IMAG:FACT {}".format(self._cast_bool(setup)))
-        self._connector.write(":SAVE:IMAG:FORM {}".format(image_format))
-        self._connector.write(":SAVE:IMAG:INKS {}".format('COL' if color else 'GRAY'))
-        self._connector.write(":SAVE:IMAG:STAR")
-
-    def setup_waveform(self, waveform_format=WAVEFORM_FORMAT.BYTE):
+        with self.batch():
+            self._connector.write(":SAVE:IMAG:FIL \"{}\"".format(path))
+            self._connector.write(":SAVE:IMAG:FACT {}".format(self._cast_bool(setup)))
+            self._connector.write(":SAVE:IMAG:FORM {}".format(image_format))
+            self._connector.write(":SAVE:IMAG:INKS {}".format('COL' if color else 'GRAY'))
+            self._connector.write(":SAVE:IMAG:STAR")
+
+    def setup_waveform(self, waveform_format=WAVEFORM_FORMAT.BYTE, points=None, points_mode=None):
         self._waveform_format = waveform_format
 
-        self._connector.write(":WAV:FORM {}".format(waveform_format))
-        self._connector.write(":WAV:BYT LSBF")
-        self._connector.write(":WAV:UNS 1")
-        # self._connector.write(":WAV:POIN:MODE MAX")
-        self._connector.write(":WAV:POIN 200000")
-        # self._connector.write(":WAV:POIN 10000")
+        if points is None:
+            points = self._WAVEFORM_POINTS_DEFAULT
+
+        with self.batch():
+            self._connector.write(":WAV:FORM {}".format(waveform_format))
+            self._connector.write(":WAV:BYT LSBF")
+            self._connector.write(":WAV:UNS 1")
+
+            # NORMal decimates the screen record on the scope, RAW and MAXimum read acquisition memory
+            if points_mode is not None:
+                self._connector.write(":WAV:POIN:MODE {}".format(points_mode))
+
+            self._connector.write(":WAV:POIN {}".format(int(points)))
+
+        self._invalidate_preamble()
+
+    @classmethod
+    def get_waveform_points(cls, secs_per_div, resolution):
+        """Number of points needed across the screen for a given time resolution"""
+        return int(math.ceil(cls._TIME_DIVISIONS * secs_per_div / resolution))
+
+    @classmethod
+    def get_waveform_format(cls, snr):
+        """Smallest waveform format with quantisation noise below the required SNR (in dB)"""
+        return cls.WAVEFORM_FORMAT.BYTE if snr <= cls._WAVEFORM_BYTE_SNR else cls.WAVEFORM_FORMAT.WORD
+
+    def get_bytes_transferred(self):
+        return self._bytes_transferred
+
+    # Setup snapshots
+    def get_setup(self):
+        """Complete scope setup as a binary blob"""
+        return str(self._connector.query_block(":SYST:SET?"))
+
+    def set_setup(self, setup):
+        self._connector.write_raw(":SYST:SET ", setup)
+
+        # Restored settings replace everything written so far
+        self.invalidate_settings()
+        self._invalidate_preamble()
+
+        err = self._connector.query(":SYST:ERR?").split(',', 1)
+
+        if int(err[0]) != 0:
+            raise InstrumentException("Setup restore failed: {}".format(err[-1].strip('"')))
 
     def setup_waveform_smart(self):
         self.setup_waveform(self.WAVEFORM_FORMAT.BYTE)
-        self._channel_v_cache = [0] * self._channels
+        self._channel_v_cache = {}
 
         self._smart_ready = True
 
+    # Measurements
+    def setup_measurements(self, measurements, statistics=True):
+        """Install measurements on the scope display, each is (MEASUREMENT, channel) or (MEASUREMENT, ch1, ch2)"""
+        with self.batch():
+            self._connector.write(":MEAS:CLE")
+
+            for measurement in measurements:
+                self._connector.write(":MEAS:{} {}".format(measurement[0], self._measurement_sources(measurement)))
+
+            if statistics:
+                self._connector.write(":MEAS:STAT ON")
+                self._connector.write(":MEAS:STAT:RES")
+
+    def get_measurements(self, measurements):
+        """Read measurement results for the last acquisition in one message, unavailable results are NaN"""
+        queries = [":MEAS:{}? {}".format(measurement[0], self._measurement_sources(measurement))
+                   for measurement in measurements]
+
+        result = numpy.array([float(x) for x in self._connector.query_compound(queries)])
+        result[numpy.abs(result) >= self._MEASUREMENT_INVALID] = numpy.nan
+
+        return result
+
+    def reset_measurement_statistics(self):
+        self._connector.write(":MEAS:STAT:RES")
+
+    def get_measurement_statistics(self):
+        """Returns (label, current, minimum, maximum, mean, std_dev, count) for each installed measurement"""
+        fields = self._connector.query(":MEAS:RES?").split(',')
+
+        if len(fields) % 7 != 0:
+            raise InstrumentException('Invalid measurement statistics')
+
+        return [(fields[n].strip(),) + tuple(float(x) for x in fields[n + 1:n + 7]) for n in range(0, len(fields), 7)]
+
+    @staticmethod
+    def _measurement_sources(measurement):
+        return ','.join("CHAN{}".format(channel) for channel in measurement[1:])
+
     # Waveform capture
     def get_waveform_raw(self, source, channel=-1, segment=False):
+        if segment:
+            return self.get_waveform_segments(source, channel)[0]
+
         # Select data source
         self._connector.write(":WAV:SOUR {}{}".format(source, channel if channel >= 0 else ''))
 
-        # Get segment count
-        if segment:
-            wave_count = int(self._connector.query(":WAV:SEGM:COUN?"));
-        else:
-            wave_count = 1
-        
-        wave_data = []
-        
+        return self._read_waveform()
+
+    def get_waveform_segments(self, source, channel=-1):
+        # Select data source
+        self._connector.write(":WAV:SOUR {}{}".format(source, channel if channel >= 0 else ''))
+
+        wave_count = int(self._connector.query(":WAV:SEGM:COUN?"))
+
+        if self._segment_bulk:
+            try:
+                return self._read_waveform_segments_bulk(wave_count)
+            except (InstrumentException, visa.VisaIOError):
+                # Older firmware lacks :WAV:SEGM:ALL, fall back to reading one segment at a time from now on
+                self._logger.exception('Bulk segment readout failed, reverting to per-segment transfers')
+                self._segment_bulk = False
+
+                # Discard the rest of a partly transferred block before sending anything else
+                self._connector.device_clear()
+                self._connector.write(":WAV:SEGM:ALL OFF")
+                self.clear()
+
+        wave_data = None
+        wave_time = numpy.empty(wave_count)
+
         for segment in range(0, wave_count):
             # Select segment
             self._connector.write(":ACQ:SEGM:IND {}".format(segment + 1))
-            
-            waveform_data = self._connector.query_raw(":WAV:DATA?")
 
-            if waveform_data[0] != '#':
-                return []
+            data = self._read_waveform()
 
-            wave_start = 2 + int(waveform_data[1])
-            wave_size = int(waveform_data[2:wave_start])
+            if wave_data is None:
+                wave_data = numpy.empty((wave_count, len(data)), dtype=data.dtype)
 
-            if self._waveform_format == self.WAVEFORM_FORMAT.WORD:
-                wave_size /= 2
+            wave_data[segment] = data
+            wave_time[segment] = float(self._connector.query(":WAV:SEGM:TTAG?"))
 
-            data = []
+        return wave_data, wave_time
 
-            for x in range(0, wave_size):
-                if self._waveform_format == self.WAVEFORM_FORMAT.WORD:
-                    i = wave_start + x * 2
-                    y = struct.unpack('<H', waveform_data[i:i + 2])[0]
-                else:
-                    i = wave_start + x
-                    y = struct.unpack('>B', waveform_data[i])[0]
+    def _read_waveform_segments_bulk(self, wave_count):
+        # All segments are returned back to back in a single block, time tags are listed in one response
+        self._connector.write(":WAV:SEGM:ALL ON")
 
-                data.append((x, y))
-            
-            wave_data.append(data)
+        try:
+            data = self._read_waveform()
+            wave_time = numpy.fromstring(self._connector.query(":WAV:SEGM:XLIS? TTAG"), sep=',')
+        finally:
+            self._connector.write(":WAV:SEGM:ALL OFF")
 
-        if segment:
-            return wave_data
-        else:
-            return wave_data[0]
+        if wave_count < 1 or len(data) % wave_count != 0 or len(wave_time) != wave_count:
+            raise InstrumentException("Segment readout returned {} points and {} time tags for {} segments".format(
+                len(data), len(wave_time), wave_count))
 
-    def process_waveform(self, data, segment=False):
-        if segment:
-            # Select segment
-            self._connector.write(':ACQ:SEGM:IND 1')
-            
-            wave_count = int(self._connector.query(":WAV:SEGM:COUN?"));
-        else:
-            wave_count = 1
-            
-            data = [data];
-    
-        header = self._connector.query(":WAV:PRE?").split(',')
+        return data.reshape((wave_count, -1)), wave_time
 
-        if len(header) != 10:
-            return []
+    def set_segment_bulk(self, enabled):
+        self._segment_bulk = enabled
 
-        t_step = float(header[4])
-        t_origin = float(header[5])
-        t_ref = int(header[6])
-        v_step = float(header[7])
-        v_origin = float(header[8])
-        v_ref = int(header[9])
+    def _read_waveform(self):
+        buf = self._connector.query_block(":WAV:DATA?")
+        self._bytes_transferred += len(buf)
 
-        segment_data = []
-        
-        for segment in range(0, wave_count):
-            return_data = []
+        return self._decode_waveform(buf)
 
-            for d in data[segment]:
-                t = (d[0] - t_ref) * t_step + t_origin
-                v = (d[1] - v_ref) * v_step + v_origin
+    def _decode_waveform(self, buf):
+        # Interpret the block payload in place, BYTE data is unsigned 8-bit and WORD data is little-endian 16-bit
+        dtype = self._WAVEFORM_DTYPE[self._waveform_format]
 
-                return_data.append((d[0], d[1], t, v))
-            
-            segment_data.append(return_data)
+        return numpy.frombuffer(buf, dtype=dtype, count=len(buf) // dtype.itemsize)
 
-        if segment:
-            return segment_data
-        else:
-            return segment_data[0]
+    def _invalidate_preamble(self):
+        self._preamble_cache.clear()
+        self._time_axis_cache.clear()
+
+    def get_preamble(self, source, channel=-1):
+        key = (source, channel)
+
+        if key not in self._preamble_cache:
+            self._connector.write(":WAV:SOUR {}{}".format(source, channel if channel >= 0 else ''))
+            header = self._connector.query(":WAV:PRE?").split(',')
+
+            if len(header) != 10:
+                raise InstrumentException('Invalid waveform preamble')
+
+            self._preamble_cache[key] = WaveformPreamble(header)
+
+        return self._preamble_cache[key]
+
+    def get_time_axis(self, preamble, points):
+        key = (preamble.x_increment, preamble.x_origin, preamble.x_reference, points)
+
+        # Channels sharing a timebase get the same array
+        if key not in self._time_axis_cache:
+            self._time_axis_cache[key] = (numpy.arange(points) - preamble.x_reference) * preamble.x_increment + \
+                preamble.x_origin
+
+        return self._time_axis_cache[key]
+
+    def process_waveform(self, data, source=WAVEFORM_SOURCE.CHANNEL, channel=-1):
+        preamble = self.get_preamble(source, channel)
+
+        # Segmented data is scaled in one pass as a (segments, points) array
+        data = numpy.asarray(data)
+
+        t = self.get_time_axis(preamble, data.shape[-1])
+        v = (data - float(preamble.y_reference)) * preamble.y_increment + preamble.y_origin
+
+        return t, v
 
     def get_waveform(self, channel, trigger=True, timeout=_TIMEOUT_DEFAULT, source=None, segment=False):
         if source is None:
@@ -628,97 +1691,157 @@ class Oscilloscope(Instrument):
             self.trigger_single(timeout)
 
         data = self.get_waveform_raw(source, channel, segment=segment)
-        return self.process_waveform(data, segment=segment)
+        return self.process_waveform(data, source, channel)
 
-    def get_waveform_auto(self, source, channel=-1):
-        data = []
+    def get_waveform_async(self, channel, trigger=True, timeout=_TIMEOUT_DEFAULT, source=None, segment=False):
+        return self.run_async(self.get_waveform, channel, trigger, timeout, source, segment)
 
-        for v in self._VOLTAGE_STEPS:
-            self.set_channel_scale(channel, v)
-            data = self.get_waveform(source, channel)
+    def get_waveform_pipelined(self, channels, count, timeout=_TIMEOUT_DEFAULT):
+        """Generator yielding (t, [v, ...]) for count acquisitions of channels
 
-            flag = True
+        Each acquisition is copied to waveform memory and the next one is armed before the copy is transferred, so
+        the scope acquires while the host transfers and processes the previous waveforms."""
+        if len(channels) > self._WAVE_MEM_COUNT:
+            raise InstrumentException("Only {} waveform memories available".format(self._WAVE_MEM_COUNT))
 
-            for n in data:
-                # Check data bounds, discard and switch ranges if clipping has occurred
-                if n[1] == 0 or \
-                        (self._waveform_format == self.WAVEFORM_FORMAT.BYTE and n[1] == 255) or \
-                        (self._waveform_format == self.WAVEFORM_FORMAT.WORD and n[1] == 65536):
-                    flag = False
-                    break
+        trigger = self.trigger_single_async(timeout) if count > 0 else None
 
-            if flag:
-                break
+        try:
+            for n in range(count):
+                try:
+                    trigger.result()
+                except InstrumentTimeoutException:
+                    raise InstrumentTimeoutException('Oscilloscope trigger timeout')
+                finally:
+                    trigger = None
 
-        return data
+                with self.batch():
+                    for mem, channel in enumerate(channels, 1):
+                        self._connector.write(":WMEM{}:SAVE CHAN{}".format(mem, channel))
+
+                if n + 1 < count:
+                    trigger = self.trigger_single_async(timeout)
+
+                t = None
+                v = []
+
+                for mem in range(1, len(channels) + 1):
+                    data = self.get_waveform_raw(self.WAVEFORM_SOURCE.WAVE_MEM, mem)
+                    t, mem_v = self.process_waveform(data, self.WAVEFORM_SOURCE.WAVE_MEM, mem)
+                    v.append(mem_v)
+
+                yield t, v
+        finally:
+            # Leave the scope idle if the consumer stops early
+            if trigger is not None:
+                trigger.exception()
+
+    def get_waveform_auto(self, source, channel=-1):
+        data = self._get_waveform_autorange(source, [channel])[0]
+
+        return self.process_waveform(data, source, channel)
 
     def get_waveform_smart(self, channels, timeout=_TIMEOUT_DEFAULT, process=True):
         if not self._smart_ready:
             raise InstrumentException('Oscilloscope has not been initialized for smart capture')
 
-        flags = [True] * len(channels)
-        return_data = [0] * len(channels)
-        v = self._channel_v_cache
+        return_data = self._get_waveform_autorange(self.WAVEFORM_SOURCE.CHANNEL, channels, timeout)
+
+        if process:
+            return_data = [self.process_waveform(data, self.WAVEFORM_SOURCE.CHANNEL, ch)
+                           for data, ch in zip(return_data, channels)]
 
-        loop = 0
+        return return_data
 
-        while True in flags:
-            active_channels = [(i, ch) for i, ch in enumerate(channels) if flags[i]]
+    def _get_waveform_autorange(self, source, channels, timeout=_TIMEOUT_DEFAULT):
+        """Capture raw waveforms, adjusting the volts/div of each channel until the signal fills the screen"""
+        return_data = [None] * len(channels)
+        fallback_data = [None] * len(channels)
+        last_data = [None] * len(channels)
+        active = range(len(channels))
 
-            for tup in active_channels:
-                n = tup[1] - 1  # Channel index (for v cache)
-                ch = tup[1]     # Channel number
+        # Scale learned for each channel carries over between captures
+        v = [self._channel_v_cache.get(ch, 0) for ch in channels]
+        v_prev = list(v)
 
-                # Set channel(s) volts per division
-                self.set_channel_scale(ch, self._VOLTAGE_STEPS[v[n]])
+        for attempt in range(len(self._VOLTAGE_STEPS)):
+            for i in active:
+                self.set_channel_scale(channels[i], self._VOLTAGE_STEPS[v[i]])
 
-            # Trigger scope
             self.trigger_single(timeout)
 
-            # Dump data from active channels
-            for tup in active_channels:
-                i = tup[0]      # Return index
-                n = tup[1] - 1  # Channel index (for v cache)
-                ch = tup[1]     # Channel number
-
-                data = self.get_waveform_raw(self.WAVEFORM_SOURCE.CHANNEL, ch)
-                raw_data = [x[1] for x in data]
-
-                if any((n in raw_data) for n in (0, 1, 255)):
-                    # Over threshold, if previous data exists then return it, else change ranges
-                    if type(return_data[i]) == list:
-                        flags[i] = False
-
-                        # Reset volts setting to correct one
-                        self.set_channel_scale(ch, self._VOLTAGE_STEPS[self._channel_v_cache[n]])
-                    elif (v[n] + 1) >= len(self._VOLTAGE_STEPS):
-                            return_data[i] = self.process_waveform(data) if process else data
-                            self._channel_v_cache[n] = v[n]
-                            flags[i] = False
+            for i in list(active):
+                ch = channels[i]
+                raw_data = self.get_waveform_raw(source, ch)
+                last_data[i] = raw_data
+                clipped, v_target = self._autorange_step(raw_data, v[i])
+
+                if clipped:
+                    if fallback_data[i] is not None:
+                        # Stepped down too far, use the previous capture
+                        return_data[i] = fallback_data[i]
+                        v[i] = v_prev[i]
+                        active.remove(i)
+                    elif v[i] + 1 >= len(self._VOLTAGE_STEPS):
+                        # Nothing more to do at the largest scale
+                        return_data[i] = raw_data
+                        active.remove(i)
                     else:
-                        v[n] += 1
+                        v_prev[i] = v[i]
+                        v[i] = max(v_target, min(v[i] + self._AUTORANGE_CLIP_STEPS, len(self._VOLTAGE_STEPS) - 1))
+                elif v_target < v[i]:
+                    # Signal fits a smaller scale, keep this capture in case the smaller one clips
+                    fallback_data[i] = raw_data
+                    v_prev[i] = v[i]
+                    v[i] = v_target
                 else:
-                    # Data is good
-                    return_data[i] = self.process_waveform(data) if process else data
-                    self._channel_v_cache[n] = v[n]
+                    return_data[i] = raw_data
+                    active.remove(i)
 
-                    # Check for lower bound, also exit if the previous data was bad (this is the first good step)
-                    if v[n] == 0 or loop > 0:
-                        flags[i] = False
-                    else:
-                        # If maximum in data is less than next step down then step down to increase resolution
-                        f = max((abs(x) for x in raw_data)) - 128 + 2
-                        f *= self._VOLTAGE_STEPS[v[n]] / self._VOLTAGE_STEPS[v[n] - 1]
+            if not active:
+                break
 
-                        if f > 127 or f < -127:
-                            flags[i] = False
-                        else:
-                            v[n] -= 1
+        # Out of attempts, use the best capture available
+        for i in active:
+            if fallback_data[i] is not None:
+                return_data[i] = fallback_data[i]
+                v[i] = v_prev[i]
+            else:
+                return_data[i] = last_data[i]
 
-            loop += 1
+        for i, ch in enumerate(channels):
+            self._channel_v_cache[ch] = v[i]
+
+            # Leave the scope on the learned scale
+            self.set_channel_scale(ch, self._VOLTAGE_STEPS[v[i]])
 
         return return_data
 
+    def _autorange_step(self, raw_data, v):
+        """Returns (clipped, index into _VOLTAGE_STEPS that fits the signal at the target fill)"""
+        codes = numpy.asarray(raw_data).ravel()
+
+        # Codes at the limits of the ADC range are holes or clipped samples
+        code_max = numpy.iinfo(codes.dtype).max
+        clipped = bool(numpy.count_nonzero((codes <= 1) | (codes == code_max)))
+
+        if codes.dtype.itemsize > 1:
+            codes = codes >> 8 * (codes.dtype.itemsize - 1)
+
+        histogram = numpy.bincount(codes, minlength=256)
+        occupied = numpy.flatnonzero(histogram[2:255]) + 2
+
+        if clipped or len(occupied) == 0:
+            return clipped, v
+
+        # Peak excursion from centre as a fraction of half the screen
+        fill = max(occupied[-1] - self._CODE_CENTER, self._CODE_CENTER - occupied[0]) / float(self._CODE_CENTER - 1)
+        target_scale = self._VOLTAGE_STEPS[v] * fill / self._AUTORANGE_FILL
+
+        v_target = numpy.searchsorted(self._VOLTAGE_STEPS, target_scale)
+
+        return False, int(min(v_target, len(self._VOLTAGE_STEPS) - 1))
+
 
 class PowerSupply(Instrument):
     def __init__(self, connector, bus_address = False):
@@ -727,6 +1850,9 @@ class PowerSupply(Instrument):
     def clear_alarm(self):
         self._connector.write(":OUTP:PROT:CLE", self._bus_address)
 
+        # Protection trips change the output state behind our back
+        self.invalidate_settings()
+
     def get_current(self):
         return float(self._connector.query(":MEAS:CURR?", self._bus_address))
 
@@ -734,16 +1860,18 @@ class PowerSupply(Instrument):
         return float(self._connector.query(":MEAS?", self._bus_address))
 
     def get_power(self):
-        return self.get_voltage() * self.get_current()
+        current, voltage = self._connector.query_compound([":MEAS:CURR?", ":MEAS?"], self._bus_address)
+
+        return float(voltage) * float(current)
 
     def set_output_enable(self, enabled):
-        self._connector.write(":OUTP {}".format(self._cast_bool(enabled)), self._bus_address)
+        self._write_setting(":OUTP", self._cast_bool(enabled))
 
     def set_voltage(self, voltage):
-        self._connector.write(":VOLT {}".format(voltage), self._bus_address)
+        self._write_setting(":VOLT", voltage)
 
     def set_current(self, current):
-        self._connector.write(":CURR {}".format(current), self._bus_address)
+        self._write_setting(":CURR", current)
 
 
 class SignalGenerator(Instrument):
@@ -751,25 +1879,27 @@ class SignalGenerator(Instrument):
                                 EXT_BACK='EXT2')
 
     def set_output(self, enabled):
-        self._connector.write(":OUTP:STAT {}".format(self._cast_bool(enabled)))
+        self._write_setting(":OUTP:STAT", self._cast_bool(enabled))
 
     def set_frequency(self, frequency):
-        self._connector.write(":FREQ:MODE CW")
-        self._connector.write(":FREQ {}".format(frequency))
+        with self.batch():
+            self._write_setting(":FREQ:MODE", "CW")
+            self._write_setting(":FREQ", frequency)
 
     def set_power(self, power):
-        self._connector.write(":POW {}dBm".format(power))
+        self._write_setting(":POW", "{}dBm".format(power))
 
     def set_pulse(self, enabled):
         self._connector.write(":PULM:STAT ".format(self._cast_bool(enabled)))
 
     def set_pulse_source(self, source):
-        self._connector.write(":PULM:SOUR {}".format(source))
+        with self.batch():
+            self._connector.write(":PULM:SOUR {}".format(source))
 
-        if source == self.PULSEMOD_SOURCE.INT_PULSE:
-            self._connector.write(":PULM:INT:FUNC:SHAP PULS")
-        elif source == self.PULSEMOD_SOURCE.INT_SQUARE:
-            self._connector.write(":PULM:INT:FUNC:SHAP SQU")
+            if source == self.PULSEMOD_SOURCE.INT_PULSE:
+                self._connector.write(":PULM:INT:FUNC:SHAP PULS")
+            elif source == self.PULSEMOD_SOURCE.INT_SQUARE:
+                self._connector.write(":PULM:INT:FUNC:SHAP SQU")
 
     def set_pulse_count(self, count):
         self._connector.write(":PULM:COUN {}".format(count))
@@ -118,11 +118,30 @@ class TemperatureExperiment(Experiment):
         self._logger.info(u"Initial temperature: {}°C, step: {}°C".format(self._temperature, self._temperature_step))
 
         # Setup temperature regulation hardware
-        logger = templogger.TemperatureLogger(logger_port)
+        if self._cfg.has_option(self._CFG_SECTION, 'logger_max_age'):
+            logger = templogger.TemperatureLogger(logger_port, self._cfg.getfloat(self._CFG_SECTION, 'logger_max_age'))
+        else:
+            logger = templogger.TemperatureLogger(logger_port)
+
+        # Frames are read continuously in the background so readings do not wait on the serial port
+        if self._cfg.has_option(self._CFG_SECTION, 'logger_poll'):
+            logger_poll = self._cfg.getboolean(self._CFG_SECTION, 'logger_poll')
+        else:
+            logger_poll = True
+
+        if logger_poll:
+            logger.start()
 
-        supply_connector = equipment.VISAConnector(supply_address, term_chars='\r', use_bus_address=True)
+        supply_connector = equipment.registry.open(supply_address, term_chars='\r', use_bus_address=True)
         supply = equipment.PowerSupply(supply_connector, supply_bus_id)
 
+        # Skip repeated writes of an unchanged PID output
+        if self._cfg.has_option(self._CFG_SECTION, 'supply_settings_cache'):
+            supply.set_settings_cache(self._cfg.getboolean(self._CFG_SECTION, 'supply_settings_cache'))
+
+        self._supply = supply
+        self._supply_connector = supply_connector
+
         self._logger_ambient_channel = logger_ambient_channel
         self._logger_sensor_channel = logger_sensor_channel
         self._temperature_regulator = regulator.TemperatureRegulator(logger, logger_sensor_channel, supply, pid_param,
@@ -167,6 +186,11 @@ class TemperatureExperiment(Experiment):
             if not user_input.lower() in ['y', 'yes', 'true', '1']:
                 raise
 
+        self._logger.debug("Supply settings cache: {} writes skipped, {} sent".format(
+            *self._supply.get_settings_cache_stats()))
+        self._logger.debug("Supply bus: {switches} address changes, {switches_avoided} avoided, settle time "
+                           "{settle_time} sec".format(**self._supply_connector.get_bus_stats()))
+
         # Check that the regulator is still working
         if not self._temperature_regulator.is_running():
             self._logger.error('Temperature regulator is not running')
@@ -207,13 +231,15 @@ class TemperatureExperiment(Experiment):
         state = {
             'target_temperature': self._temperature_regulator.get_target(),
             'ambient_temperature': self._temperature_regulator.get_temperature(self._logger_ambient_channel),
-            'sensor_temperature': self._temperature_regulator.get_temperature(),
-            'supply_voltage': self._temperature_regulator.get_voltage(),
-            'supply_current': self._temperature_regulator.get_current()
+            'sensor_temperature': self._temperature_regulator.get_temperature()
         }
 
         self._temperature_regulator.lock_release()
 
+        # Supply connector queues these behind control loop writes, no need to hold the controller lock
+        state['supply_voltage'] = self._temperature_regulator.get_voltage()
+        state['supply_current'] = self._temperature_regulator.get_current()
+
         return dict(state.items() + parent_state.items())
 
 
@@ -167,8 +167,9 @@ class MKSSerialMonitor:
             self._MKS_FIELD_PREFIX + 'timestamp': 0
         })
 
-        # Start receiver thread
-        self._update = threading.Event()
+        # Start receiver thread, updates are counted so every waiting consumer sees each new packet
+        self._update = threading.Condition()
+        self._update_count = 0
         self._working = threading.Event()
         self._stop = threading.Event()
         self._lock = threading.Lock()
@@ -190,9 +191,15 @@ class MKSSerialMonitor:
     def is_working(self):
         return self._working.is_set()
 
+    def get_port(self):
+        return self._port_name
+
     def update_wait(self, timeout=None):
-        self._update.clear()
-        return self._update.wait(timeout)
+        with self._update:
+            update_count = self._update_count
+            self._update.wait(timeout)
+
+            return self._update_count != update_count
 
     def get_state(self):
         with self._lock:
@@ -297,7 +304,9 @@ class MKSSerialMonitor:
                                 self._export_fields = export_fields
                                 
                             # Wake all waiting threads
-                            self._update.set()
+                            with self._update:
+                                self._update_count += 1
+                                self._update.notify_all()
                         except MKSException as e:
                             self._logger.warn(e.msg)
 
@@ -310,3 +319,43 @@ class MKSSerialMonitor:
             self._working.clear()
             self._logger.exception('Exception occurred in MKS thread', exc_info=True)
             raise
+
+
+# Monitors shared between consumers, one per serial port
+_monitors = {}
+_monitors_lock = threading.Lock()
+
+
+def open_monitor(port, lag_warning=None):
+    with _monitors_lock:
+        if port in _monitors:
+            entry = _monitors[port]
+
+            if not entry[0].is_running():
+                raise MKSException("MKS monitor on {} has stopped".format(port))
+
+            entry[1] += 1
+
+            return entry[0]
+
+        monitor = MKSSerialMonitor(port, lag_warning)
+        _monitors[port] = [monitor, 1]
+
+        return monitor
+
+
+def release_monitor(monitor):
+    with _monitors_lock:
+        entry = _monitors.get(monitor.get_port())
+
+        if entry is None or entry[0] is not monitor:
+            raise MKSException("MKS monitor on {} is not shared".format(monitor.get_port()))
+
+        entry[1] -= 1
+
+        if entry[1] > 0:
+            return
+
+        del _monitors[monitor.get_port()]
+
+    monitor.stop()
@@ -134,9 +134,12 @@ class Controller:
                 input_diff = self._input_prev - input_current
 
                 self._output_value = self._limit.clamp(self._p * input_error + self._integral - self._d * input_diff)
-                self._output(self._output_value)
+                output_value = self._output_value
 
                 self._lock.release()
+
+                # Output connector serializes its own I/O, don't hold up readers for the round trip
+                self._output(output_value)
                 
                 # print "IN: {}, OUT: {}".format(input_current, self._output_value)
 
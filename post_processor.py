@@ -138,7 +138,7 @@ class FrequencyCountProcessor(PostProcessor):
 
     @staticmethod
     def get_supported_data_capture():
-        return (data_capture.FrequencyData, data_capture.FrequencyDataLegacy,)
+        return (data_capture.FrequencyData, data_capture.FrequencyDataLegacy, data_capture.FrequencyStreamData,)
 
     def process(self, data):
         f = data['result_counter_frequency'][0]
@@ -200,7 +200,7 @@ class FrequencyDisplayProcessor(PostProcessor):
 
     @staticmethod
     def get_supported_data_capture():
-        return data_capture.FrequencyData, data_capture.FrequencyDataLegacy,
+        return data_capture.FrequencyData, data_capture.FrequencyDataLegacy, data_capture.FrequencyStreamData,
 
     def process(self, data):
         t = data['capture_timestamp']
@@ -267,8 +267,8 @@ class BlackMagicDetector(PostProcessor):
 
     @staticmethod
     def get_supported_data_capture():
-        return data_capture.FrequencyData, data_capture.FrequencyDataLegacy, data_capture.PulseData, \
-               data_capture.VNAData
+        return data_capture.FrequencyData, data_capture.FrequencyDataLegacy, data_capture.FrequencyStreamData, \
+               data_capture.PulseData, data_capture.PulseMeasureData, data_capture.MultiPulseData, data_capture.VNAData
 
     def process(self, data):
         timestamp = data['capture_timestamp']
@@ -294,11 +294,11 @@ class MKSMonitorPostProcessor(PostProcessor):
         self._timeout = self._cfg.getfloat(self._CFG_SECTION, 'timeout')
 
         # Connect to MKS
-        self._mks = mks.MKSSerialMonitor(mks_port)
+        self._mks = mks.open_monitor(mks_port)
 
     @staticmethod
     def get_supported_data_capture():
-        return data_capture.PulseData,
+        return data_capture.PulseData, data_capture.PulseMeasureData, data_capture.MultiPulseData
 
     def process(self, data):
         # If data is too old then wait for an update
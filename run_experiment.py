@@ -211,6 +211,7 @@ def main():
                     root_logger.warning("{} does not support data capture {}".format(post_class, data_capture_class))
     except:
         root_logger.exception('Exception while loading post processor class', exc_info=True)
+        run_data_capture.stop()
         run_exp.stop()
         return
 
@@ -284,6 +285,15 @@ def main():
             notify.send_message("Exception occurred during experiment! Traceback:\n{}".format(traceback.format_exc()),
                                 title='jtfadump Exception')
     finally:
+        try:
+            run_data_capture.stop()
+        except:
+            root_logger.exception('Error while stopping data capture', exc_info=True)
+
+            if notify:
+                notify.send_message("Exception occurred while stopping data capture! Traceback:\n{}".format(
+                    traceback.format_exc()), title='jtfadump Exception')
+
         try:
             run_exp.stop()
         except:
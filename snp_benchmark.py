@@ -0,0 +1,196 @@
+import argparse
+import math
+import os
+import re
+import tempfile
+import timeit
+
+import numpy
+
+import util
+
+
+# Line based parser used before util.read_snp was vectorized, kept for comparison
+def read_snp_legacy(snp_path):
+    with open(snp_path, 'r') as f:
+        snp_text = f.readlines()
+
+    # Replace punctuation
+    snp_text[:] = [re.sub('[\t,]', ' ', line.upper().strip()) for line in snp_text]
+
+    # Extract the option line
+    option_line = [line for line in snp_text if re.match('^#.*', line)]
+
+    if len(option_line) != 1:
+        raise util.SNPFormatException("SNP format requires one option line ({} found)".format(len(option_line)))
+
+    option_line = option_line[0]
+
+    # Strip comments and option lines
+    snp_text = [line for line in snp_text if not re.match('^[#!].*', line)]
+
+    # Remove any invalid characters
+    snp_text[:] = [re.sub('[^A-Z0-9.+\- ]+', '', line) for line in snp_text]
+
+    # Strip empty lines
+    snp_text = filter(None, snp_text)
+
+    # Format
+    unit_multiplier = 1e9
+    parameter_type = util._SNP_PARAMETER_TYPE.S
+    unit_db = False
+    unit_angle = True
+    unit_r = 50
+
+    options = filter(None, option_line.split(' '))
+    skip = False
+
+    for n in range(1, len(options)):
+        if skip:
+            skip = False
+            continue
+
+        if re.match('^[KMG]?HZ$', options[n]):
+            if options[n][0] == 'H':
+                unit_multiplier = 1
+            elif options[n][0] == 'K':
+                unit_multiplier = 1e3
+            elif options[n][0] == 'M':
+                unit_multiplier = 1e6
+        elif re.match('^[SYZGH]$', options[n]):
+            if options[n][0] == 'H':
+                parameter_type = util._SNP_PARAMETER_TYPE.H
+            elif options[n][0] == 'G':
+                parameter_type = util._SNP_PARAMETER_TYPE.G
+            elif options[n][0] == 'Z':
+                parameter_type = util._SNP_PARAMETER_TYPE.Z
+            elif options[n][0] == 'Y':
+                parameter_type = util._SNP_PARAMETER_TYPE.Y
+        elif re.match('^(MA|DB|RI)$', options[n]):
+            if options[n][0] == 'D':
+                unit_db = True
+            elif options[n][0] == 'R':
+                unit_angle = False
+        elif options[n][0] == 'R':
+            if (n + 1) >= len(options):
+                raise util.SNPFormatException('Missing parameter for \'R\' field in option line')
+
+            unit_r = int(options[n + 1])
+            skip = True
+        else:
+            raise util.SNPFormatException("Invalid option line format (option: {})".format(options[n]))
+
+    # Analyse the number of ports in the data
+    data_length = len(snp_text)
+
+    if data_length == 1:
+        ports = 1
+    else:
+        field_count = [len(line.split(' ')) for line in snp_text]
+
+        if field_count[0] == field_count[1]:
+            ports = math.sqrt((field_count[0] - 1) / 2)
+        else:
+            ports = (field_count[0] - 1) / 2
+
+    if ports != int(ports):
+        raise util.SNPFormatException('Invalid data format')
+
+    if ports > 4:
+        raise util.SNPFormatException('SNP files with more than 4 ports are not supported')
+
+    ports = int(ports)
+
+    # Read data
+    f = []
+    data = []
+
+    if ports > 2:
+        step = ports
+    else:
+        step = 1
+
+    for n in range(0, len(snp_text), step):
+        # Concatenate multiple lines if necessary
+        if ports > 2:
+            data_line = ' '.join(snp_text[n:n + step])
+        else:
+            data_line = snp_text[n]
+
+        data_fields = [float(d) for d in data_line.split(' ')]
+
+        # 2 port data must be rearranged
+        if ports == 2:
+            data_fields = [data_fields[0], data_fields[1], data_fields[2], data_fields[5], data_fields[6],
+                           data_fields[3], data_fields[4], data_fields[7], data_fields[8]];
+
+        net_data = [[]]
+        
+        for m in range(1, len(data_fields), 2):
+            a = data_fields[m]
+            b = data_fields[m + 1]
+            
+            if unit_db:
+                a = math.pow(10, (a / 20))
+            
+            if unit_angle:
+                mag = a
+                ang = math.radians(b)
+                
+                a = mag * math.cos(ang)
+                b = mag * math.sin(ang)
+                
+            if len(net_data[-1]) == ports:
+                net_data.append([])
+            
+            net_data[-1].append(complex(a, b))
+
+        data.append(((float(data_fields[0]) * unit_multiplier), net_data))
+
+    return parameter_type, unit_r, data,
+
+
+def main():
+    parse = argparse.ArgumentParser(description='Touchstone parser benchmark')
+
+    parse.add_argument('files', help='SNP file(s) to parse', nargs='*')
+    parse.add_argument('-g', help='Generate a random file with the given ports and points', dest='generate',
+                       type=int, nargs=2, metavar=('PORTS', 'POINTS'))
+    parse.add_argument('-n', help='Number of repeats', dest='repeat', type=int, default=3)
+
+    args = parse.parse_args()
+
+    files = list(args.files)
+
+    if args.generate is not None:
+        ports, points = args.generate
+        snp_path = os.path.join(tempfile.mkdtemp(), "benchmark.s{}p".format(ports))
+
+        frequency = numpy.linspace(1e6, 1e10, points)
+        data = numpy.random.randn(points, ports, ports) + 1j * numpy.random.randn(points, ports, ports)
+        util.write_snp(snp_path, frequency, data)
+
+        files.append(snp_path)
+
+    for snp_path in files:
+        legacy_type, legacy_r, legacy_data = read_snp_legacy(snp_path)
+        snp_type, snp_r, snp_frequency, snp_data = util.read_snp(snp_path)
+
+        # Both parsers must agree before timing them
+        legacy_frequency = numpy.array([d[0] for d in legacy_data])
+        legacy_data = numpy.array([d[1] for d in legacy_data])
+
+        match = legacy_type == snp_type and legacy_r == snp_r and \
+            numpy.allclose(legacy_frequency, snp_frequency) and numpy.allclose(legacy_data, snp_data)
+
+        legacy_time = min(timeit.repeat(lambda: read_snp_legacy(snp_path), number=1, repeat=args.repeat))
+        snp_time = min(timeit.repeat(lambda: util.read_snp(snp_path), number=1, repeat=args.repeat))
+
+        print("{}: {} points, {} ports{}".format(snp_path, snp_data.shape[0], snp_data.shape[1],
+                                                '' if match else ' (MISMATCH)'))
+        print("  legacy {:.3f} sec, numpy {:.3f} sec ({:.1f}x)".format(legacy_time, snp_time,
+                                                                     legacy_time / snp_time))
+
+
+if __name__ == "__main__":
+    main()
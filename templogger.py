@@ -3,6 +3,8 @@
 import logging
 import serial
 import struct
+import threading
+import time
 
 
 class TemperatureLogger:
@@ -11,27 +13,121 @@ class TemperatureLogger:
 
     _PAYLOAD_REQUEST = 'A'
     _PAYLOAD_SIZE = 45
-    _PAYLOAD_DATA_OFFSET_LOW = 7
-    _PAYLOAD_DATA_OFFSET_HIGH = 9
+    _PAYLOAD_DATA_OFFSET = 7
 
-    def __init__(self, port):
+    # All channels are decoded from each frame, channels are addressed by byte offset from the data offset
+    _PAYLOAD_DATA_STRUCT = struct.Struct('>4h')
+    _PAYLOAD_CHANNEL_STRUCT = struct.Struct('>h')
+
+    # Age of the latest frame before get_temperature() reads a new one
+    _MAX_AGE = 0.5
+
+    # Wait between polls after a failed read, doubled on each consecutive failure
+    _ERROR_WAIT_MIN = 1
+    _ERROR_WAIT_MAX = 30
+
+    def __init__(self, port, max_age=_MAX_AGE):
         self._logger = logging.getLogger(__name__)
 
         self._logger.debug(u"Connecting temperature logger on COM{} at {}bps".format(port, self._SERIAL_SPEED))
 
         # Open serial port
         self._port = serial.Serial(port, self._SERIAL_SPEED, timeout=self._SERIAL_TIMEOUT)
+        self._port_lock = threading.Lock()
 
-    def get_temperature(self, channel=0):
-        # Logger returns data when prompted with 'A' character
-        self._port.write(self._PAYLOAD_REQUEST)
-        self._port.flush()
+        # Latest decoded frame as (timestamp, frame, temperatures)
+        self._snapshot = None
+        self._max_age = max_age
 
-        r = self._port.read(self._PAYLOAD_SIZE)
-        # Unpack data into platform appropriate format
-        t = (struct.unpack('>h',
-                           r[self._PAYLOAD_DATA_OFFSET_LOW+channel:self._PAYLOAD_DATA_OFFSET_HIGH+channel])[0]) / 10.0
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self, poll_interval=0):
+        """Read frames continuously on a background thread"""
+        if self.is_running():
+            return
+
+        self._stop.clear()
+
+        self._thread = threading.Thread(target=self._poll, args=(poll_interval,), name="Temperature logger")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, wait=False):
+        self._stop.set()
+
+        if wait and self._thread is not None:
+            self._thread.join()
+
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive() and not self._stop.is_set()
+
+    def get_snapshot(self, max_age=None):
+        """Get the latest (timestamp, temperatures) of all channels, a new frame is read if it is too old"""
+        snapshot = self._get_snapshot(max_age)
+
+        return snapshot[0], snapshot[2]
+
+    def get_temperature(self, channel=0, max_age=None):
+        snapshot = self._get_snapshot(max_age)
+
+        if channel % self._PAYLOAD_CHANNEL_STRUCT.size == 0 and channel < self._PAYLOAD_DATA_STRUCT.size:
+            t = snapshot[2][channel // self._PAYLOAD_CHANNEL_STRUCT.size]
+        else:
+            t = self._PAYLOAD_CHANNEL_STRUCT.unpack_from(snapshot[1], self._PAYLOAD_DATA_OFFSET + channel)[0] / 10.0
 
         self._logger.debug(u"{} READ ch{}: {}°C".format(self._port.name, channel, t))
 
         return t
+
+    def _get_snapshot(self, max_age):
+        max_age = self._max_age if max_age is None else max_age
+        snapshot = self._snapshot
+
+        if snapshot is None or time.time() - snapshot[0] > max_age:
+            snapshot = self._read_frame()
+
+        return snapshot
+
+    def _read_frame(self):
+        # Logger returns data when prompted with 'A' character
+        with self._port_lock:
+            self._port.write(self._PAYLOAD_REQUEST)
+            self._port.flush()
+
+            r = self._port.read(self._PAYLOAD_SIZE)
+
+        if len(r) != self._PAYLOAD_SIZE:
+            raise IOError("Expected {} bytes from temperature logger but got {}".format(self._PAYLOAD_SIZE, len(r)))
+
+        # Unpack data into platform appropriate format
+        temperatures = tuple(x / 10.0 for x in self._PAYLOAD_DATA_STRUCT.unpack_from(r, self._PAYLOAD_DATA_OFFSET))
+
+        snapshot = (time.time(), r, temperatures)
+        self._snapshot = snapshot
+
+        return snapshot
+
+    def _poll(self, poll_interval):
+        error_wait = None
+
+        while not self._stop.is_set():
+            try:
+                self._read_frame()
+            except Exception as e:
+                # Readers fall back to reading frames themselves once the snapshot expires
+                if error_wait is None:
+                    self._logger.exception('Exception occurred in temperature logger thread', exc_info=True)
+                    error_wait = self._ERROR_WAIT_MIN
+                else:
+                    self._logger.warning("Temperature logger still failing: {}".format(e))
+                    error_wait = min(2 * error_wait, self._ERROR_WAIT_MAX)
+
+                self._stop.wait(max(poll_interval, error_wait))
+                continue
+
+            if error_wait is not None:
+                self._logger.info('Temperature logger recovered')
+                error_wait = None
+
+            self._stop.wait(poll_interval)
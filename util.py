@@ -1,10 +1,15 @@
 import code
+import collections
+import hashlib
 import math
+import numpy
+import os
 import random
 import re
 import string
 from subprocess import Popen, PIPE
 import threading
+import Queue
 import time
 import sys
 
@@ -49,6 +54,16 @@ def interact(scope):
     code.interact(local=scope)
 
 
+def file_hash(path, block_size=65536):
+    h = hashlib.sha1()
+
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), ''):
+            h.update(block)
+
+    return h.hexdigest()
+
+
 def interruptable_sleep(seconds):
     def _sleep_method(t, stop):
         for t in range(t)[::-1]:
@@ -76,6 +91,146 @@ def interruptable_sleep(seconds):
     sys.stdout.write('\n')
 
 
+class FutureTimeoutError(Exception):
+    def __init__(self, value):
+        self.value = value
+
+    def __str__(self):
+        return self.value
+
+
+class Future:
+    """Result of an operation completing on another thread"""
+    # Waits without a timeout cannot be interrupted, so they are split into short waits
+    _WAIT_INTERVAL = 0.1
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+        self._result = None
+        self._exc_info = None
+
+    def done(self):
+        return self._done.is_set()
+
+    def result(self, timeout=None):
+        if not self._wait(timeout):
+            raise FutureTimeoutError("Result not ready after {} sec".format(timeout))
+
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._wait(timeout):
+            raise FutureTimeoutError("Result not ready after {} sec".format(timeout))
+
+        return None if self._exc_info is None else self._exc_info[1]
+
+    def _wait(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+
+        while not self._done.is_set():
+            if deadline is None:
+                self._done.wait(self._WAIT_INTERVAL)
+            elif time.time() < deadline:
+                self._done.wait(min(self._WAIT_INTERVAL, deadline - time.time()))
+            else:
+                return False
+
+        return True
+
+    def add_done_callback(self, func):
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+
+        func(self)
+
+    def set_result(self, result):
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exc_info):
+        self._exc_info = exc_info
+        self._finish()
+
+    def _finish(self):
+        with self._lock:
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for func in callbacks:
+            func(self)
+
+
+class Executor:
+    """Single worker thread running submitted calls in order"""
+    def __init__(self, name):
+        self._queue = Queue.Queue()
+        self._shutdown = False
+
+        self._thread = threading.Thread(target=self._run, name=name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def submit(self, func, *args, **kwargs):
+        if self._shutdown:
+            raise RuntimeError("{} has been shut down".format(self._thread.name))
+
+        future = Future()
+
+        # Calls made from the worker run immediately rather than waiting on themselves
+        if threading.current_thread() is self._thread:
+            self._execute(future, func, args, kwargs)
+        else:
+            self._queue.put((future, func, args, kwargs))
+
+        return future
+
+    def shutdown(self, wait=True):
+        """Stop the worker once calls already submitted have run"""
+        if not self._shutdown:
+            self._shutdown = True
+            self._queue.put(None)
+
+        if wait and threading.current_thread() is not self._thread:
+            self._thread.join()
+
+    @staticmethod
+    def _execute(future, func, args, kwargs):
+        try:
+            result = func(*args, **kwargs)
+        except:
+            future.set_exception(sys.exc_info())
+        else:
+            future.set_result(result)
+
+    def _run(self):
+        while True:
+            work = self._queue.get()
+
+            if work is None:
+                return
+
+            self._execute(*work)
+
+
+def wait_all(futures, timeout=None):
+    """Wait for all futures, then return their results in order or raise the first exception"""
+    deadline = None if timeout is None else time.time() + timeout
+
+    for future in futures:
+        future.exception(None if deadline is None else max(0, deadline - time.time()))
+
+    return [future.result() for future in futures]
+
+
 # SNP file reading
 class SNPFormatException(Exception):
     def __init__(self, value):
@@ -86,142 +241,382 @@ class SNPFormatException(Exception):
 
 
 _SNP_PARAMETER_TYPE = enum(S='S', Y='Y', Z='Z', G='G', H='H')
+_SNP_FREQUENCY_UNIT = {'HZ': 1, 'KHZ': 1e3, 'MHZ': 1e6, 'GHZ': 1e9}
+
+_SNP_COMMENT_REGEX = re.compile('!.*')
+_SNP_KEYWORD_REGEX = re.compile(r'\[([^\]]*)\]')
+_SNP_EXTENSION_REGEX = re.compile(r'\.S(\d+)P$', re.I)
 
 
 def read_snp(snp_path):
+    """Read a Touchstone (version 1 or 2) file, returns (parameter type, reference impedance, frequency, data)
+
+    Frequency is in Hz and data is a complex (points, ports, ports) array.
+    """
     with open(snp_path, 'r') as f:
-        snp_text = f.readlines()
+        snp_text = f.read()
+
+    # Strip comments and punctuation, the text is only scanned by whole-string operations
+    if '!' in snp_text:
+        snp_text = _SNP_COMMENT_REGEX.sub('', snp_text)
 
-    # Replace punctuation
-    snp_text[:] = [re.sub('[\t,]', ' ', line.upper().strip()) for line in snp_text]
+    if ',' in snp_text:
+        snp_text = snp_text.replace(',', ' ')
 
     # Extract the option line
-    option_line = [line for line in snp_text if re.match('^#.*', line)]
+    option_count = snp_text.count('#')
 
-    if len(option_line) != 1:
-        raise SNPFormatException("SNP format requires one option line ({} found)".format(len(option_line)))
+    if option_count != 1:
+        raise SNPFormatException("SNP format requires one option line ({} found)".format(option_count))
 
-    option_line = option_line[0]
+    option_start = snp_text.index('#')
+    option_end = snp_text.find('\n', option_start)
 
-    # Strip comments and option lines
-    snp_text = [line for line in snp_text if not re.match('^[#!].*', line)]
+    if option_end < 0:
+        option_end = len(snp_text)
 
-    # Remove any invalid characters
-    snp_text[:] = [re.sub('[^A-Z0-9.+\- ]+', '', line) for line in snp_text]
+    options = snp_text[option_start + 1:option_end].upper().split()
+    snp_text = snp_text[:option_start] + snp_text[option_end:]
+
+    # Split into keyword sections, version 1 files only have the leading section
+    if '[' in snp_text:
+        sections = _SNP_KEYWORD_REGEX.split(snp_text)
+    else:
+        sections = [snp_text]
 
-    # Strip empty lines
-    snp_text = filter(None, snp_text)
+    keywords = {sections[n].strip().upper(): sections[n + 1] for n in range(1, len(sections), 2)}
 
     # Format
     unit_multiplier = 1e9
     parameter_type = _SNP_PARAMETER_TYPE.S
-    unit_db = False
-    unit_angle = True
+    data_format = 'MA'
     unit_r = 50
 
-    options = filter(None, option_line.split(' '))
-    skip = False
-
-    for n in range(1, len(options)):
-        if skip:
-            skip = False
-            continue
-
-        if re.match('^[KMG]?HZ$', options[n]):
-            if options[n][0] == 'H':
-                unit_multiplier = 1
-            elif options[n][0] == 'K':
-                unit_multiplier = 1e3
-            elif options[n][0] == 'M':
-                unit_multiplier = 1e6
-        elif re.match('^[SYZGH]$', options[n]):
-            if options[n][0] == 'H':
-                parameter_type = _SNP_PARAMETER_TYPE.H
-            elif options[n][0] == 'G':
-                parameter_type = _SNP_PARAMETER_TYPE.G
-            elif options[n][0] == 'Z':
-                parameter_type = _SNP_PARAMETER_TYPE.Z
-            elif options[n][0] == 'Y':
-                parameter_type = _SNP_PARAMETER_TYPE.Y
-        elif re.match('^(MA|DB|RI)$', options[n]):
-            if options[n][0] == 'D':
-                unit_db = True
-            elif options[n][0] == 'R':
-                unit_angle = False
-        elif options[n][0] == 'R':
+    n = 0
+
+    while n < len(options):
+        if options[n] in _SNP_FREQUENCY_UNIT:
+            unit_multiplier = _SNP_FREQUENCY_UNIT[options[n]]
+        elif options[n] in ['S', 'Y', 'Z', 'G', 'H']:
+            parameter_type = options[n]
+        elif options[n] in ['MA', 'DB', 'RI']:
+            data_format = options[n]
+        elif options[n] == 'R':
             if (n + 1) >= len(options):
                 raise SNPFormatException('Missing parameter for \'R\' field in option line')
 
-            unit_r = int(options[n + 1])
-            skip = True
+            unit_r = float(options[n + 1])
+            n += 1
         else:
             raise SNPFormatException("Invalid option line format (option: {})".format(options[n]))
 
-    # Analyse the number of ports in the data
-    data_length = len(snp_text)
+        n += 1
+
+    matrix_format = 'FULL'
+    two_port_order = '21_12'
+
+    if 'VERSION' in keywords:
+        # Version 2 data follows the network data keyword and stops at the next keyword
+        if 'NETWORK DATA' not in keywords or 'NUMBER OF PORTS' not in keywords:
+            raise SNPFormatException('SNP version 2 requires number of ports and network data keywords')
+
+        snp_body = keywords['NETWORK DATA']
+        ports = int(keywords['NUMBER OF PORTS'])
 
-    if data_length == 1:
-        ports = 1
+        if 'TWO-PORT DATA ORDER' in keywords:
+            two_port_order = keywords['TWO-PORT DATA ORDER'].strip().upper()
+        elif ports == 2:
+            raise SNPFormatException('SNP version 2 requires two-port data order for 2 port data')
+
+        if 'MATRIX FORMAT' in keywords:
+            matrix_format = keywords['MATRIX FORMAT'].strip().upper()
+
+        if 'REFERENCE' in keywords:
+            unit_r = [float(x) for x in keywords['REFERENCE'].split()]
+
+            if len(unit_r) != ports:
+                raise SNPFormatException("Expected {} reference impedances but got {}".format(ports, len(unit_r)))
+
+            if len(set(unit_r)) == 1:
+                unit_r = unit_r[0]
     else:
-        field_count = [len(line.split(' ')) for line in snp_text]
+        snp_body = sections[0]
+        extension = _SNP_EXTENSION_REGEX.search(snp_path)
 
-        if field_count[0] == field_count[1]:
-            ports = math.sqrt((field_count[0] - 1) / 2)
+        if extension:
+            ports = int(extension.group(1))
         else:
-            ports = (field_count[0] - 1) / 2
+            # Guess the number of ports from the fields in the first lines
+            field_count = [len(line.split()) for line in snp_body.splitlines() if line.strip()][:2]
+
+            if len(field_count) == 1:
+                ports = 1
+            elif field_count[0] == field_count[1]:
+                ports = math.sqrt((field_count[0] - 1) / 2.0)
+            else:
+                ports = (field_count[0] - 1) / 2.0
+
+            if ports != int(ports):
+                raise SNPFormatException('Invalid data format')
+
+            ports = int(ports)
+
+        # 2 port files may end with noise parameters with 5 fields per line
+        if ports == 2:
+            lines = snp_body.splitlines()
+            n = len(lines)
+
+            while n > 0 and len(lines[n - 1].split()) in [0, 5]:
+                n -= 1
+
+            if n < len(lines):
+                snp_body = '\n'.join(lines[:n])
 
-    if ports != int(ports):
-        raise SNPFormatException('Invalid data format')
+    if ports < 1:
+        raise SNPFormatException('Invalid number of ports')
+
+    # Matrix elements present in each point
+    if matrix_format == 'FULL':
+        index = numpy.indices((ports, ports)).reshape(2, -1)
+    elif matrix_format == 'LOWER':
+        index = numpy.tril_indices(ports)
+    elif matrix_format == 'UPPER':
+        index = numpy.triu_indices(ports)
+    else:
+        raise SNPFormatException("Invalid matrix format {}".format(matrix_format))
 
-    if ports > 4:
-        raise SNPFormatException('SNP files with more than 4 ports are not supported')
+    # Convert the whole numeric body at once
+    try:
+        values = numpy.array(snp_body.split(), dtype=numpy.float64)
+    except ValueError as e:
+        raise SNPFormatException("Invalid data ({})".format(e))
 
-    ports = int(ports)
+    point_length = 1 + 2 * len(index[0])
 
-    # Read data
-    f = []
-    data = []
+    if len(values) % point_length != 0:
+        raise SNPFormatException("Data length {} is not a multiple of {} values per point".format(len(values),
+                                                                                                  point_length))
 
-    if ports > 2:
-        step = ports
+    values = values.reshape(-1, point_length)
+    points = len(values)
+
+    if 'NUMBER OF FREQUENCIES' in keywords and int(keywords['NUMBER OF FREQUENCIES']) != points:
+        raise SNPFormatException("Expected {} frequencies but got {}".format(keywords['NUMBER OF FREQUENCIES'],
+                                                                             points))
+
+    frequency = values[:, 0] * unit_multiplier
+    a = values[:, 1::2]
+    b = values[:, 2::2]
+
+    if data_format == 'RI':
+        elements = a + 1j * b
     else:
-        step = 1
+        if data_format == 'DB':
+            a = 10 ** (a / 20)
+
+        elements = a * numpy.exp(1j * numpy.radians(b))
+
+    data = numpy.zeros((points, ports, ports), dtype=numpy.complex128)
+    data[:, index[0], index[1]] = elements
+
+    if matrix_format != 'FULL':
+        # Mirror the stored triangle
+        data[:, index[1], index[0]] = elements
+    elif ports == 2 and two_port_order == '21_12':
+        data = data.transpose(0, 2, 1).copy()
+
+    return parameter_type, unit_r, frequency, data
+
+
+def write_snp(snp_path, frequency, data, parameter_type=_SNP_PARAMETER_TYPE.S, r=50):
+    """Write (points, ports, ports) network data as a Touchstone file in RI format with frequency in Hz"""
+    ports = data.shape[1]
+
+    if ports == 2:
+        # 2 port data is stored column-major
+        rows = [data.transpose(0, 2, 1).reshape(len(frequency), 4)]
+    else:
+        rows = [data[:, n, :] for n in range(ports)]
+
+    with open(snp_path, 'w') as f:
+        f.write("! {} port network data\n".format(ports))
+        f.write("# HZ {} RI R {}\n".format(parameter_type, r))
+
+        for n in range(len(frequency)):
+            for m, row in enumerate(rows):
+                # Each line holds at most 4 complex values
+                for k in range(0, len(row[n]), 4):
+                    fields = ' '.join("{:.12g} {:.12g}".format(x.real, x.imag) for x in row[n][k:k + 4])
+
+                    if m == 0 and k == 0:
+                        f.write("{:.12g} {}\n".format(frequency[n], fields))
+                    else:
+                        f.write("  {}\n".format(fields))
+
+
+class SNPCache:
+    """Parsed SNP files kept in memory and in .npz sidecar files, each evicted least recently used by total size"""
+    _SIDECAR_EXTENSION = '.npz'
+
+    # Sidecars of Touchstone files, other .npz files are never counted or deleted
+    _SIDECAR_REGEX = re.compile(r'\.s\d+p\.npz$', re.IGNORECASE)
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_sidecar_bytes=1024 * 1024 * 1024):
+        self._max_bytes = max_bytes
+        self._bytes = 0
+        self._cache = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+        # Sidecar files on disk by path, oldest use first, seeded from each directory when first seen
+        self._max_sidecar_bytes = max_sidecar_bytes
+        self._sidecar_bytes = 0
+        self._sidecars = collections.OrderedDict()
+        self._sidecar_dirs = set()
+
+    def read(self, snp_path):
+        """Read an SNP file with the same result as read_snp(), parsing it only when no valid copy exists"""
+        snp_path = os.path.abspath(snp_path)
+        stat = os.stat(snp_path)
+
+        with self._lock:
+            entry = self._cache.pop(snp_path, None)
+
+            if entry is not None and entry[0] == (stat.st_size, stat.st_mtime):
+                self._cache[snp_path] = entry
+
+                # Keep the sidecar of a file still in use from being evicted
+                sidecar_size = self._sidecars.pop(snp_path + self._SIDECAR_EXTENSION, None)
+
+                if sidecar_size is not None:
+                    self._sidecars[snp_path + self._SIDECAR_EXTENSION] = sidecar_size
+
+                return entry[1]
+
+            if entry is not None:
+                self._bytes -= entry[2]
+
+        snp = self._load_sidecar(snp_path, stat)
+
+        if snp is None:
+            snp = read_snp(snp_path)
+            self.save_sidecar(snp_path, snp)
+
+        self._store(snp_path, (stat.st_size, stat.st_mtime), snp)
 
-    for n in range(0, len(snp_text), step):
-        # Concatenate multiple lines if necessary
-        if ports > 2:
-            data_line = ' '.join(snp_text[n:n + step])
+        return snp
+
+    def save_sidecar(self, snp_path, snp):
+        """Write the parsed contents of an SNP file next to it, failures only cost a parse on the next read"""
+        stat = os.stat(snp_path)
+        parameter_type, r, frequency, data = snp
+
+        sidecar_path = os.path.abspath(snp_path) + self._SIDECAR_EXTENSION
+
+        try:
+            with open(sidecar_path, 'wb') as f:
+                numpy.savez(f, parameter_type=parameter_type, r=r, frequency=frequency, data=data,
+                            snp_size=stat.st_size, snp_mtime=stat.st_mtime, snp_hash=file_hash(snp_path))
+
+            self._touch_sidecar(sidecar_path, os.path.getsize(sidecar_path))
+        except (IOError, OSError):
+            pass
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+            self._bytes = 0
+
+    def _load_sidecar(self, snp_path, stat):
+        sidecar_path = snp_path + self._SIDECAR_EXTENSION
+
+        if not os.path.exists(sidecar_path):
+            return None
+
+        try:
+            with numpy.load(sidecar_path) as sidecar:
+                if int(sidecar['snp_size']) != stat.st_size:
+                    return None
+
+                # A changed modification time alone (eg. copied files) is checked against the contents
+                refresh = float(sidecar['snp_mtime']) != stat.st_mtime
+
+                if refresh and str(sidecar['snp_hash']) != file_hash(snp_path):
+                    return None
+
+                snp = (str(sidecar['parameter_type']), sidecar['r'].tolist(), sidecar['frequency'], sidecar['data'])
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+        if refresh:
+            self.save_sidecar(snp_path, snp)
         else:
-            data_line = snp_text[n]
+            try:
+                self._touch_sidecar(sidecar_path, os.path.getsize(sidecar_path))
+            except OSError:
+                pass
 
-        data_fields = [float(d) for d in data_line.split(' ')]
+        return snp
 
-        # 2 port data must be rearranged
-        if ports == 2:
-            data_fields = [data_fields[0], data_fields[1], data_fields[2], data_fields[5], data_fields[6],
-                           data_fields[3], data_fields[4], data_fields[7], data_fields[8]];
-
-        net_data = [[]]
-        
-        for m in range(1, len(data_fields), 2):
-            a = data_fields[m]
-            b = data_fields[m + 1]
-            
-            if unit_db:
-                a = math.pow(10, (a / 20))
-            
-            if unit_angle:
-                mag = a
-                ang = math.radians(b)
-                
-                a = mag * math.cos(ang)
-                b = mag * math.sin(ang)
-                
-            if len(net_data[-1]) == ports:
-                net_data.append([])
-            
-            net_data[-1].append(complex(a, b))
-
-        data.append(((float(data_fields[0]) * unit_multiplier), net_data))
-
-    return parameter_type, unit_r, data,
+    def _touch_sidecar(self, sidecar_path, size):
+        directory = os.path.dirname(sidecar_path)
+
+        with self._lock:
+            if directory not in self._sidecar_dirs:
+                self._sidecar_dirs.add(directory)
+                self._scan_sidecars(directory)
+
+            old_size = self._sidecars.pop(sidecar_path, None)
+
+            if old_size is not None:
+                self._sidecar_bytes -= old_size
+
+            self._sidecars[sidecar_path] = size
+            self._sidecar_bytes += size
+
+            while self._sidecar_bytes > self._max_sidecar_bytes and len(self._sidecars) > 1:
+                path, old_size = self._sidecars.popitem(last=False)
+                self._sidecar_bytes -= old_size
+
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    def _scan_sidecars(self, directory):
+        # Sidecars left by earlier runs count towards the budget, oldest modification first
+        found = []
+
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+
+            if self._SIDECAR_REGEX.search(name) and os.path.isfile(path[:-len(self._SIDECAR_EXTENSION)]):
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                found.append((stat.st_mtime, path, stat.st_size))
+
+        for _, path, size in sorted(found):
+            if path not in self._sidecars:
+                self._sidecars[path] = size
+                self._sidecar_bytes += size
+
+    def _store(self, snp_path, key, snp):
+        nbytes = snp[2].nbytes + snp[3].nbytes
+
+        with self._lock:
+            entry = self._cache.pop(snp_path, None)
+
+            if entry is not None:
+                self._bytes -= entry[2]
+
+            self._cache[snp_path] = (key, snp, nbytes)
+            self._bytes += nbytes
+
+            while self._bytes > self._max_bytes and len(self._cache) > 1:
+                _, entry = self._cache.popitem(last=False)
+                self._bytes -= entry[2]
+
+
+snp_cache = SNPCache()
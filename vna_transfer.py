@@ -24,7 +24,7 @@ def main():
     vna_address = cfg.get(data_capture.VNAData._CFG_SECTION, 'vna_address')
     print("Connect to ".format(vna_address))
 
-    vna_connector = equipment.VISAConnector(vna_address)
+    vna_connector = equipment.registry.open(vna_address)
 
     vna = equipment.NetworkAnalyzer(vna_connector)
 